@@ -0,0 +1,1101 @@
+import os
+import json
+import fcntl
+import hashlib
+import numpy as np
+import threading
+import multiprocessing
+
+from copy import copy
+from Queue import Queue
+from collections import namedtuple
+from tensorflow.python.framework import dtypes
+
+
+# All raw datasets are serialized here exactly once [uint8 pixels + int labels]
+# and then memory-mapped read-only by every process that needs them, so N
+# concurrent experiments share a single page-cached copy.
+STORE_PATH = "Store_data"
+
+Datasets = namedtuple('Datasets', ['train', 'validation', 'test'])
+
+# Derived (stage) stores are content-addressed as stage_<hash of the input
+# store, the stage, its version & parameters>; together they are bounded by
+# STAGE_CACHE_BYTES and evicted least recently used first [except the ones
+# some process has open, see _use_store]. Bump a stage's version whenever
+# its output changes so that stale caches are not re-opened.
+STAGE_PREFIX = "stage_"
+STAGE_CACHE_BYTES = 16 * 1024 ** 3
+RESIZE_VERSION = 1
+ROTATE_VERSION = 1
+
+# base filename -> lock file, held [shared] for the life of the process
+_STORE_LOCKS = {}
+
+
+def _store_filenames(name, split, path=STORE_PATH):
+    base = os.path.join(path, "%s_%s" % (name, split))
+    return base + '_imgs.npy', base + '_labels.npy'
+
+
+def store_exists(name, splits, path=STORE_PATH):
+    ''' True if every split of the named store is on disk '''
+    for split in splits:
+        imgs_file, labels_file = _store_filenames(name, split, path)
+        if not os.path.exists(imgs_file) or not os.path.exists(labels_file):
+            return False
+
+    return True
+
+
+def _atomic_save(filename, arr):
+    ''' np.save to a temp file and rename so that concurrent
+        readers never observe a partially written array '''
+    tmp_filename = "%s.%d.tmp" % (filename, os.getpid())
+    with open(tmp_filename, 'wb') as f:
+        np.save(f, arr)
+
+    os.rename(tmp_filename, filename)
+
+
+def write_store(name, split, images, labels, path=STORE_PATH,
+                images_dtype=np.uint8):
+    ''' serializes a single split as raw uint8 [or images_dtype]
+        pixels and int labels '''
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    imgs_file, labels_file = _store_filenames(name, split, path)
+    _atomic_save(imgs_file, np.asarray(images, dtype=images_dtype))
+    _atomic_save(labels_file, np.asarray(labels, dtype=np.int32))
+    print 'serialized %s [%s] to %s...' % (name, split, imgs_file)
+
+
+class StoreWriter(object):
+    '''
+    Streams the images of a split into a preallocated on-disk array
+    so that splits larger than memory can be written chunk by chunk;
+    the store only appears [atomically] once close() is called.
+    '''
+    def __init__(self, name, split, shape, path=STORE_PATH,
+                 images_dtype=np.uint8):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        self.name, self.split = name, split
+        self.imgs_file, self.labels_file = _store_filenames(name, split, path)
+        self.tmp_filename = "%s.%d.tmp" % (self.imgs_file, os.getpid())
+        self.images = np.lib.format.open_memmap(self.tmp_filename, mode='w+',
+                                                dtype=images_dtype,
+                                                shape=tuple(shape))
+
+    def write(self, begin, images):
+        self.images[begin:begin + len(images)] = images
+
+    def close(self, labels):
+        self.images.flush()
+        self.images = None
+        os.rename(self.tmp_filename, self.imgs_file)
+        _atomic_save(self.labels_file, np.asarray(labels, dtype=np.int32))
+        print 'serialized %s [%s] to %s...' % (self.name, self.split,
+                                               self.imgs_file)
+
+
+def stage_store_name(name, stage, params, version=1):
+    ''' name of the store derived from store name by [version of] a stage
+        with params; the repr keeps the fields apart '''
+    key = repr((name, stage, version, tuple(params)))
+    return STAGE_PREFIX + hashlib.sha1(key).hexdigest()
+
+
+def _lock_filename(base, path=STORE_PATH):
+    return os.path.join(path, base + '.lock')
+
+
+def _use_store(name, split, path=STORE_PATH):
+    '''
+    Marks a store as recently used for the LRU stage cache and holds a
+    shared lock on it until this process exits, so that no other process
+    evicts it while it is memory-mapped here.
+    '''
+    for filename in _store_filenames(name, split, path):
+        try:
+            os.utime(filename, None)
+        except OSError:
+            pass
+
+    base = "%s_%s" % (name, split)
+    if base not in _STORE_LOCKS:
+        lock = open(_lock_filename(base, path), 'a')
+        fcntl.flock(lock, fcntl.LOCK_SH)
+        _STORE_LOCKS[base] = lock
+
+
+def evict_stage_cache(path=STORE_PATH, max_bytes=STAGE_CACHE_BYTES, keep=()):
+    '''
+    Removes the least recently used stage stores until all of them fit in
+    max_bytes; stores in keep [(name, split)] and the ones locked by any
+    running process [see _use_store] are never removed. An evicted store
+    is just rebuilt the next time it is needed.
+    '''
+    keep = set(os.path.basename(_store_filenames(name, split, path)[0])
+               for name, split in keep)
+    stores = {}
+    for filename in os.listdir(path):
+        if not filename.startswith(STAGE_PREFIX) or not filename.endswith('.npy'):
+            continue
+
+        stat = os.stat(os.path.join(path, filename))
+        base = filename.rsplit('_', 1)[0]  # <name>_<split>
+        size, mtime = stores.get(base, (0, 0))
+        stores[base] = (size + stat.st_size, max(mtime, stat.st_mtime))
+
+    total = sum(size for size, _ in stores.values())
+    for base, (size, _) in sorted(stores.items(), key=lambda kv: kv[1][1]):
+        if total <= max_bytes:
+            break
+
+        if base + '_imgs.npy' in keep:
+            continue
+
+        with open(_lock_filename(base, path), 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                continue  # in use
+
+            for suffix in ['_imgs.npy', '_labels.npy', '.lock']:
+                try:
+                    os.remove(os.path.join(path, base + suffix))
+                except OSError:
+                    pass
+
+        total -= size
+        print 'evicted %s from the stage cache...' % base
+
+
+def open_store(name, split, path=STORE_PATH, mmap_mode='r'):
+    ''' returns the (images, labels) of a split; images are memory-mapped '''
+    imgs_file, labels_file = _store_filenames(name, split, path)
+    return np.load(imgs_file, mmap_mode=mmap_mode), np.load(labels_file)
+
+
+def _file_sha1(filename, block_size=1 << 22):
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+
+    return h.hexdigest()
+
+
+def _signature_filename(name, path=STORE_PATH):
+    return os.path.join(path, "%s_sources.json" % name)
+
+
+def _read_signature(name, path=STORE_PATH):
+    try:
+        with open(_signature_filename(name, path), 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def _source_signature(sources, previous={}):
+    '''
+    {filename: {size, mtime, sha1}} of the source files the store was
+    built from; the (full file) sha1 is only recomputed when the
+    size & mtime differ from the previously recorded signature.
+    '''
+    signature = {}
+    for filename in sources:
+        stat = os.stat(filename)
+        entry = {'size': stat.st_size, 'mtime': int(stat.st_mtime)}
+        prev = previous.get(filename, {})
+        if prev.get('size') == entry['size'] \
+           and prev.get('mtime') == entry['mtime']:
+            entry['sha1'] = prev.get('sha1')
+        else:
+            entry['sha1'] = _file_sha1(filename)
+
+        signature[filename] = entry
+
+    return signature
+
+
+def store_is_stale(name, sources, path=STORE_PATH):
+    '''
+    True if any (still present) source file differs in size or content
+    from the ones the store was built from. Sources that were deleted
+    after building do not invalidate the store.
+    '''
+    previous = _read_signature(name, path)
+    present = [filename for filename in sources if os.path.exists(filename)]
+    current = _source_signature(present, previous)
+    for filename, entry in current.items():
+        prev = previous.get(filename, {})
+        if prev.get('size') != entry['size'] or prev.get('sha1') != entry['sha1']:
+            return True
+
+    # only touched: remember the new mtimes so we do not re-hash next time
+    if any(previous[f].get('mtime') != e['mtime'] for f, e in current.items()):
+        previous.update(current)
+        _write_signature_dict(name, previous, path)
+
+    return False
+
+
+def _write_signature_dict(name, signature, path=STORE_PATH):
+    tmp_filename = "%s.%d.tmp" % (_signature_filename(name, path), os.getpid())
+    with open(tmp_filename, 'w') as f:
+        json.dump(signature, f, indent=2, sort_keys=True)
+
+    os.rename(tmp_filename, _signature_filename(name, path))
+
+
+def write_signature(name, sources, path=STORE_PATH):
+    ''' records the signature of the source files of a store
+        [merged with the ones recorded for its other splits] '''
+    signature = _read_signature(name, path)
+    signature.update(_source_signature(sources))
+    _write_signature_dict(name, signature, path)
+
+
+def load_or_build_store(name, splits, build_fn, path=STORE_PATH,
+                        sources=None, images_dtype=np.uint8):
+    '''
+    Opens all splits of the named store, calling build_fn() only
+    when the store does not exist yet [or, if source filenames are
+    given, when they changed since it was built]. build_fn must
+    return a dict of {split: (uint8 images, int labels)}.
+    '''
+    if not store_exists(name, splits, path) \
+       or (sources is not None and store_is_stale(name, sources, path)):
+        built = build_fn()
+        for split in splits:
+            write_store(name, split, built[split][0], built[split][1],
+                        path, images_dtype)
+
+        del built
+        if sources is not None:
+            write_signature(name, sources, path)
+
+    return dict((split, open_store(name, split, path)) for split in splits)
+
+
+def _bilinear_coords(src_size, dst_size):
+    ''' source rows/cols & weights for a half-pixel aligned bilinear resize '''
+    coords = (np.arange(dst_size) + 0.5) * (float(src_size) / dst_size) - 0.5
+    coords = np.clip(coords, 0, src_size - 1)
+    lo = np.floor(coords).astype(np.int64)
+    hi = np.minimum(lo + 1, src_size - 1)
+    return lo, hi, (coords - lo).astype(np.float32)
+
+
+def resize_batch(images, new_dims):
+    ''' vectorized bilinear resize of [N, H, W(, C)] images to new_dims '''
+    extra_dims = [1] * (images.ndim - 3)
+    y0, y1, wy = _bilinear_coords(images.shape[1], new_dims[0])
+    x0, x1, wx = _bilinear_coords(images.shape[2], new_dims[1])
+    wy = wy.reshape([1, -1, 1] + extra_dims)
+    wx = wx.reshape([1, 1, -1] + extra_dims)
+
+    imgs = np.asarray(images, dtype=np.float32)
+    rows = imgs[:, y0] * (1.0 - wy) + imgs[:, y1] * wy
+    resized = rows[:, :, x0] * (1.0 - wx) + rows[:, :, x1] * wx
+    if images.dtype == np.uint8:
+        return np.clip(np.round(resized), 0, 255).astype(np.uint8)
+
+    return resized
+
+
+def _resize_chunk(args):
+    images, new_dims = args
+    return resize_batch(images, new_dims)
+
+
+def parallel_imap(func, tasks, num_workers=None):
+    ''' ordered imap of func over tasks on a process pool
+        [runs inline if there is only a single task] '''
+    if len(tasks) <= 1:
+        for task in tasks:
+            yield func(task)
+
+        return
+
+    pool = multiprocessing.Pool(num_workers)
+    try:
+        for result in pool.imap(func, tasks):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _as_square(images):
+    ''' views flat [N, H*W] images as [N, H, W] '''
+    if images.ndim == 2:
+        side = int(np.sqrt(images.shape[1]))
+        return images.reshape([-1, side, side])
+
+    return images
+
+
+def parallel_map(chunk_fn, images, args=(), chunk_size=4096, num_workers=None):
+    '''
+    Maps chunk_fn((chunk,) + args) over chunks of chunk_size images on a
+    process pool [chunk_fn has to be a module level function] and gathers
+    the results into a single preallocated array.
+    '''
+    num_images = images.shape[0]
+    chunks = [(begin, min(begin + chunk_size, num_images))
+              for begin in range(0, num_images, chunk_size)]
+    results = parallel_imap(chunk_fn,
+                            [(images[begin:end],) + tuple(args)
+                             for begin, end in chunks],
+                            num_workers)
+    mapped = None
+    for (begin, end), chunk in zip(chunks, results):
+        if mapped is None:
+            mapped = np.empty((num_images,) + chunk.shape[1:], dtype=chunk.dtype)
+
+        mapped[begin:end] = chunk
+
+    return mapped if mapped is not None else chunk_fn((images,) + tuple(args))
+
+
+def parallel_resize(images, new_dims, chunk_size=4096, num_workers=None):
+    '''
+    Resizes [N, H, W(, C)] (or flat square [N, H*W]) images in chunks
+    of chunk_size spread over a process pool; returns [N] + new_dims (+ C)
+    '''
+    return parallel_map(_resize_chunk, _as_square(images), (new_dims,),
+                        chunk_size, num_workers)
+
+
+def map_split(dataset, stage_name, chunk_fn, args=(), path=STORE_PATH,
+              version=1):
+    '''
+    Applies parallel_map(chunk_fn, images, args) to a DataSet in place.
+    If the DataSet is backed by a named store the WHOLE backing array is
+    mapped once and cached in the stage store of (name, stage_name,
+    version, args) [bump version when chunk_fn changes];
+    every view of the same store then just re-opens that cache. Otherwise
+    only the rows of the view are mapped.
+    '''
+    if dataset._store_key is None:
+        dataset.materialize()
+        dataset._images = parallel_map(chunk_fn, dataset._images, args)
+        return dataset
+
+    name, split = dataset._store_key
+    mapped_name = stage_store_name(name, stage_name,
+                                   [dataset._images.shape] + list(args),
+                                   version)
+    if not store_exists(mapped_name, [split], path):
+        write_store(mapped_name, split,
+                    parallel_map(chunk_fn, dataset._images, args),
+                    dataset._labels, path)
+        evict_stage_cache(path, keep=[(mapped_name, split)])
+
+    _use_store(mapped_name, split, path)
+    dataset._images, _ = open_store(mapped_name, split, path)
+    dataset._store_key = (mapped_name, split)
+    return dataset
+
+
+def resize_split(dataset, new_dims, path=STORE_PATH):
+    '''
+    Resizes the images of a DataSet in place. If the DataSet is backed
+    by a named store the WHOLE backing array is resized once and cached
+    [see map_split]; the DataSet and every other view of the same store
+    then just re-opens that cache. Otherwise only the rows of the view
+    are resized.
+    '''
+    dataset._images = _as_square(dataset._images)
+    return map_split(dataset, "resize", _resize_chunk,
+                     (list(new_dims),), path, RESIZE_VERSION)
+
+
+# The angles used for the rotated [10x + 1] lifelong experiments
+ROTATION_ANGLES = [30, 45, 70, 90, 130, 165, 200, 250, 295, 335]
+
+
+def rotate_batch(images, angle):
+    '''
+    Vectorized bilinear rotation of [N, H, W] images by angle degrees
+    counter-clockwise about the image center [same convention as
+    scipy.misc.imrotate]; pixels rotated in from outside are zero.
+    '''
+    height, width = images.shape[1], images.shape[2]
+    theta = np.deg2rad(angle)
+    cy, cx = (height - 1) / 2.0, (width - 1) / 2.0
+    dy, dx = np.meshgrid(np.arange(height) - cy, np.arange(width) - cx,
+                         indexing='ij')
+
+    # inverse map every output pixel back into the source image
+    src_x = cx + np.cos(theta) * dx - np.sin(theta) * dy
+    src_y = cy + np.sin(theta) * dx + np.cos(theta) * dy
+    x0 = np.floor(src_x).astype(np.int64)
+    y0 = np.floor(src_y).astype(np.int64)
+    wx = (src_x - x0).astype(np.float32)
+    wy = (src_y - y0).astype(np.float32)
+
+    imgs = np.asarray(images, dtype=np.float32)
+    rotated = np.zeros(imgs.shape, dtype=np.float32)
+    for oy, ox, weight in [(0, 0, (1 - wy) * (1 - wx)), (0, 1, (1 - wy) * wx),
+                           (1, 0, wy * (1 - wx)), (1, 1, wy * wx)]:
+        ys, xs = y0 + oy, x0 + ox
+        valid = (ys >= 0) & (ys < height) & (xs >= 0) & (xs < width)
+        rotated += imgs[:, np.clip(ys, 0, height - 1), np.clip(xs, 0, width - 1)] \
+            * (weight * valid)
+
+    if images.dtype == np.uint8:
+        return np.clip(np.round(rotated), 0, 255).astype(np.uint8)
+
+    return rotated
+
+
+def _rotate_chunk(args):
+    images, angle = args
+    return rotate_batch(_as_square(images), angle).reshape(images.shape)
+
+
+def _rotation_store_name(name, angles):
+    return stage_store_name(name, "rotate", angles, ROTATE_VERSION)
+
+
+def build_rotation_store(name, split, images, labels, angles=ROTATION_ANGLES,
+                         path=STORE_PATH, chunk_size=4096, num_workers=None):
+    '''
+    Rotates every image of a split by every angle on a process pool and
+    streams the result into a single [num_angles, N, ...] uint8 array
+    on disk [written to a temp file and renamed once complete].
+    '''
+    rotated = StoreWriter(_rotation_store_name(name, angles), split,
+                          (len(angles),) + images.shape, path)
+    tasks = [(angle_index, begin, min(begin + chunk_size, len(images)))
+             for angle_index in range(len(angles))
+             for begin in range(0, len(images), chunk_size)]
+    results = parallel_imap(_rotate_chunk,
+                            [(images[begin:end], angles[angle_index])
+                             for angle_index, begin, end in tasks],
+                            num_workers)
+    for (angle_index, begin, end), chunk in zip(tasks, results):
+        rotated.images[angle_index, begin:end] = chunk
+
+    rotated.close(labels)
+
+
+def rotate_split(dataset, angle, angles=ROTATION_ANGLES, path=STORE_PATH):
+    '''
+    Rotates the images of a DataSet in place. Store-backed DataSets are
+    pointed at a lazy [angle] slice of the rotation store, which holds all
+    angles of the whole split and is built on first use; so every
+    (class, angle) view shares a single memory-mapped file. Other
+    DataSets only rotate the rows of the view.
+    '''
+    if dataset._store_key is None or angle not in angles:
+        dataset.materialize()
+        dataset._images = _rotate_chunk((dataset._images, angle))
+        return dataset
+
+    name, split = dataset._store_key
+    rotated_name = _rotation_store_name(name, angles)
+    if not store_exists(rotated_name, [split], path):
+        build_rotation_store(name, split, dataset._images, dataset._labels,
+                             angles, path)
+        evict_stage_cache(path, keep=[(rotated_name, split)])
+
+    _use_store(rotated_name, split, path)
+    rotations, _ = open_store(rotated_name, split, path)
+    dataset._images = rotations[angles.index(angle)]
+    dataset._store_key = ("%s_angle%d" % (name, angle), split)
+    return dataset
+
+
+class Filter(object):
+    ''' keeps the rows whose label is not in blacklist [a new index view] '''
+    def __init__(self, blacklist):
+        self.blacklist = blacklist
+
+    def __call__(self, dataset, path=STORE_PATH):
+        return dataset.filter(self.blacklist)
+
+
+class Unflatten(object):
+    ''' serves the images as [N] + dims '''
+    def __init__(self, dims):
+        self.dims = list(dims)
+
+    def __call__(self, dataset, path=STORE_PATH):
+        dataset._images = dataset._images.reshape([-1] + self.dims)
+        return dataset
+
+
+class Resize(object):
+    ''' cached bilinear resize, see resize_split '''
+    def __init__(self, new_dims):
+        self.new_dims = list(new_dims)
+
+    def __call__(self, dataset, path=STORE_PATH):
+        return resize_split(dataset, self.new_dims, path)
+
+
+class Rotate(object):
+    ''' cached rotation by one of angles, see rotate_split '''
+    def __init__(self, angle, angles=ROTATION_ANGLES):
+        self.angle = angle
+        self.angles = angles
+
+    def __call__(self, dataset, path=STORE_PATH):
+        return rotate_split(dataset, self.angle, self.angles, path)
+
+
+class ToRGB(object):
+    ''' grayscale -> rgb, broadcast per batch [nothing is cached] '''
+    def __init__(self, channels=3):
+        self.channels = channels
+
+    def __call__(self, dataset, path=STORE_PATH):
+        return dataset.to_rgb(self.channels)
+
+
+class Map(object):
+    ''' any cached pixel stage: chunk_fn((images,) + params), see map_split '''
+    def __init__(self, name, chunk_fn, params=(), version=1):
+        self.name = name
+        self.chunk_fn = chunk_fn
+        self.params = tuple(params)
+        self.version = version
+
+    def __call__(self, dataset, path=STORE_PATH):
+        return map_split(dataset, self.name, self.chunk_fn, self.params, path,
+                         self.version)
+
+
+class Pipeline(object):
+    '''
+    A declarative chain of DataSet transforms, eg:
+
+        Pipeline([Filter(blacklist), Resize([32, 32]), ToRGB()]).apply_splits(mnist)
+
+    Pixel rewriting stages are cached as content-addressed stage stores
+    [hash of the input store & stage parameters], so unchanged prefixes
+    are shared by every driver and run; the other stages only change
+    how rows are served. Stages rewrite the DataSet in place, except
+    Filter which returns a new view [so put it first].
+    '''
+    def __init__(self, stages, path=STORE_PATH):
+        self.stages = stages
+        self.path = path
+
+    def apply(self, dataset):
+        for stage in self.stages:
+            dataset = stage(dataset, self.path)
+
+        return dataset
+
+    def apply_splits(self, datasets):
+        ''' applies the pipeline to every train / [validation] / test split '''
+        return _replace_splits(datasets, dict(
+            (split, self.apply(getattr(datasets, split)))
+            for split in Datasets._fields if hasattr(datasets, split)))
+
+
+def class_pipeline(blacklist, is_flat=True, resize_dims=None,
+                   convert_to_rgb=False, dims=[28, 28]):
+    ''' the Pipeline of the 28x28 class filters [mnist, fashion]:
+        filter out the blacklist, then [unflatten, resize, rgb] '''
+    stages = [Filter(blacklist)]
+
+    # return images in [batch, row, col]
+    if not is_flat:
+        stages.append(Unflatten(dims))
+
+    # resizes images if resize_dims tuple is provided
+    if resize_dims is not None:
+        stages.append(Resize(resize_dims))
+
+    # tile images as [img, img, img]
+    if convert_to_rgb:
+        stages.append(ToRGB())
+
+    return Pipeline(stages)
+
+
+class ImageView(object):
+    ''' Array-like accessor over DataSet._images which converts
+        only the rows that are actually indexed to float32 '''
+    def __init__(self, dataset):
+        self._dataset = dataset
+
+    @property
+    def shape(self):
+        return (self._dataset._num_examples,) + self._dataset._example_shape()
+
+    @property
+    def dtype(self):
+        return self._dataset._dtype
+
+    def __len__(self):
+        return self._dataset._num_examples
+
+    def __getitem__(self, index):
+        rows = self._dataset._indices[index]
+        return self._dataset._convert(self._dataset._images[rows])
+
+    def __array__(self, dtype=None):
+        arr = self[:]
+        return arr if dtype is None else arr.astype(dtype)
+
+
+class DataSet(object):
+    def __init__(self,
+                 images,
+                 labels,
+                 one_hot=False,
+                 dtype=dtypes.float32,
+                 normalize=True,
+                 indices=None,
+                 store_key=None):
+        """Construct a DataSet.
+        one_hot arg is used only if fake_data is true.  `dtype` can be either
+        `uint8` to leave the input as `[0, 255]`, or `float32` to rescale into
+        `[0, 1]`.
+
+        Note: images are never copied here [they are usually memory-mapped];
+              uint8 pixels are converted to float32 one batch at a time.
+              `indices` restricts the DataSet to those rows of the shared
+              images / labels, see filter().
+              `store_key` is the (name, split) the images were opened from,
+              it is used to key derived caches such as resize_split().
+              Grayscale images stay single channel, see to_rgb().
+        """
+        dtype = dtypes.as_dtype(dtype).base_dtype
+        if dtype not in (dtypes.uint8, dtypes.float32):
+            raise TypeError('Invalid image dtype %r, expected uint8 or float32' %
+                            dtype)
+        assert images.shape[0] == labels.shape[0], (
+            'images.shape: %s labels.shape: %s' % (images.shape, labels.shape))
+        if indices is None:
+            indices = np.arange(images.shape[0])
+
+        self._num_examples = len(indices)
+        self._dtype = dtype.as_numpy_dtype
+        self._normalize = normalize
+
+        self._images = images
+        self._labels = labels
+        self._indices = indices
+        self._label_index = None
+        self._store_key = store_key
+        self._batch_buffers = None
+        self._samplers = None
+        self._channels = None
+        self._epochs_completed = 0
+        self._index_in_epoch = 0
+
+    def _convert(self, images):
+        ''' casts a chunk of stored images to the requested dtype,
+            scaling uint8 pixels from [0, 255] -> [0.0, 1.0] if normalize '''
+        if self._channels is not None:
+            images = np.repeat(images[..., np.newaxis], self._channels, axis=-1)
+
+        if self._dtype == np.uint8:
+            return images
+
+        if images.dtype == np.uint8 and self._normalize:
+            return np.multiply(images, 1.0 / 255.0, dtype=np.float32)
+
+        return np.asarray(images, dtype=np.float32)
+
+    def _example_shape(self):
+        ''' shape of a single example as returned in a batch '''
+        if self._channels is None:
+            return self._images.shape[1:]
+
+        return self._images.shape[1:] + (self._channels,)
+
+    def to_rgb(self, channels=3):
+        ''' serves the single channel [N, H, W] images as [N, H, W, channels];
+            the channel is only broadcast when a batch is assembled '''
+        self._images = _as_square(self._images)
+        self._channels = channels
+        return self
+
+    def label_index(self):
+        ''' {label: absolute row indices of that label in this DataSet};
+            computed once with a single argsort and cached '''
+        if self._label_index is None:
+            labels = self._labels[self._indices]
+            if labels.ndim > 1:  # one-hot
+                labels = np.argmax(labels, axis=1)
+
+            order = np.argsort(labels, kind='mergesort')
+            unique_labels, starts = np.unique(labels[order], return_index=True)
+            self._label_index = dict(zip(unique_labels,
+                                         np.split(self._indices[order],
+                                                  starts[1:])))
+
+        return self._label_index
+
+    def filter(self, blacklist):
+        ''' returns a DataSet view of the rows whose label is not in blacklist;
+            the view shares the (memory-mapped) images & labels '''
+        keep = [idx for lbl, idx in self.label_index().items()
+                if lbl not in blacklist]
+        indices = np.sort(np.concatenate(keep)) if keep \
+            else np.zeros([0], dtype=np.int64)
+        view = copy(self)
+        view._indices = indices
+        view._num_examples = len(indices)
+        view._label_index = None
+        view._batch_buffers = None
+        view._samplers = None
+        view._epochs_completed = 0
+        view._index_in_epoch = 0
+        return view
+
+    def materialize(self):
+        ''' gathers the rows of this view into its own arrays;
+            used before transforms that rewrite the pixels '''
+        self._images = self._images[self._indices]
+        self._labels = self._labels[self._indices]
+        self._indices = np.arange(self._num_examples)
+        self._label_index = None
+        self._samplers = None
+        self._store_key = None
+        return self
+
+    def take(self, rows):
+        ''' (images, labels) of the given absolute rows as new arrays '''
+        return self._convert(self._images[rows]), self._labels[rows]
+
+    def class_sampler(self, labels=None):
+        ''' cached ClassSampler over the rows of labels [all rows if None] '''
+        key = None if labels is None else tuple(labels)
+        if self._samplers is None:
+            self._samplers = {}
+
+        if key not in self._samplers:
+            self._samplers[key] = ClassSampler(self, labels)
+
+        return self._samplers[key]
+
+    @property
+    def images(self):
+        return ImageView(self)
+
+    @property
+    def labels(self):
+        return self._labels[self._indices]
+
+    @property
+    def num_examples(self):
+        return self._num_examples
+
+    @property
+    def epochs_completed(self):
+        return self._epochs_completed
+
+    def _get_batch_buffers(self, batch_size):
+        ''' preallocated (images, labels, gather scratch) for batch_size rows;
+            only reallocated if the batch size or image shape changes '''
+        shape = (batch_size,) + self._example_shape()
+        if self._batch_buffers is None or self._batch_buffers[0].shape != shape:
+            out_dtype = self._dtype if self._dtype == np.uint8 else np.float32
+            images = np.empty(shape, dtype=out_dtype)
+            scratch = images \
+                if self._images.dtype == out_dtype and self._channels is None \
+                else np.empty((batch_size,) + self._images.shape[1:],
+                              dtype=self._images.dtype)
+            labels = np.empty((batch_size,) + self._labels.shape[1:],
+                              dtype=self._labels.dtype)
+            self._batch_buffers = (images, labels, scratch)
+
+        return self._batch_buffers
+
+    def _gather(self, rows, begin):
+        ''' gathers rows into [begin:] of the batch buffers, converting
+            the stored pixels in place '''
+        images, labels, scratch = self._batch_buffers
+        end = begin + len(rows)
+        np.take(self._images, rows, axis=0, out=scratch[begin:end], mode='clip')
+        np.take(self._labels, rows, axis=0, out=labels[begin:end], mode='clip')
+        if scratch is not images:
+            # scales & broadcasts [grayscale -> rgb] straight into the batch
+            gathered = scratch[begin:end]
+            if self._channels is not None:
+                gathered = gathered[..., np.newaxis]
+
+            scale = 1.0 / 255.0 \
+                if scratch.dtype == np.uint8 and self._normalize \
+                and images.dtype != np.uint8 else 1.0
+            np.multiply(gathered, scale, out=images[begin:end],
+                        casting='unsafe')
+
+        return end
+
+    def next_batch(self, batch_size, fake_data=False, shuffle=True,
+                   copy=False):
+        """Return the next `batch_size` examples from this data set.
+
+        Note: the batch is gathered into buffers that are reused by the next
+              call [no per batch allocation and the, possibly memory-mapped,
+              images are never rewritten]: the returned arrays are
+              overwritten by the next call on this DataSet. Pass copy=True
+              [or copy them] for a batch that outlives it, eg: one that is
+              stored or handed to another thread / queue. The DataSet is
+              not thread safe, give each thread its own view [filter([])].
+        """
+        start = self._index_in_epoch
+        images, labels, _ = self._get_batch_buffers(batch_size)
+
+        # Shuffle for the first epoch
+        # Note: only the row indices are permuted, the images are never copied
+        if self._epochs_completed == 0 and start == 0 and shuffle:
+            np.random.shuffle(self._indices)
+
+        # Go to the next epoch
+        if start + batch_size > self._num_examples:
+            # Finished epoch
+            self._epochs_completed += 1
+
+            # Get the rest examples in this epoch
+            rest_num_examples = self._num_examples - start
+            end = self._gather(self._indices[start:self._num_examples], 0)
+
+            # Shuffle the data
+            if shuffle:
+                np.random.shuffle(self._indices)
+
+            # Start next epoch
+            start = 0
+            self._index_in_epoch = batch_size - rest_num_examples
+            end = self._gather(self._indices[start:batch_size - end], end)
+            images, labels = images[:end], labels[:end]
+        else:
+            self._index_in_epoch += batch_size
+            end = self._index_in_epoch
+            self._gather(self._indices[start:end], 0)
+
+        if copy:
+            return images.copy(), labels.copy()
+
+        return images, labels
+
+
+class ClassSampler(object):
+    '''
+    Draws batches from the rows of some labels of a DataSet in O(batch):
+    the rows come from the precomputed label_index() and are walked with
+    a cursor that reshuffles them at every epoch.
+    '''
+    def __init__(self, dataset, labels=None):
+        if labels is None:
+            rows = dataset._indices
+        else:
+            label_index = dataset.label_index()
+            rows = [label_index[lbl] for lbl in labels if lbl in label_index]
+            rows = np.concatenate(rows) if rows else np.zeros([0], dtype=np.int64)
+
+        if len(rows) == 0:
+            raise Exception("no examples with labels %s to sample from"
+                            % str(labels))
+
+        self.dataset = dataset
+        self.rows = np.array(rows)
+        self.cursor = len(self.rows)  # shuffle on the first draw
+
+    def next_rows(self, batch_size):
+        batch_rows = np.empty([batch_size], dtype=self.rows.dtype)
+        filled = 0
+        while filled < batch_size:
+            if self.cursor == len(self.rows):
+                np.random.shuffle(self.rows)
+                self.cursor = 0
+
+            count = min(batch_size - filled, len(self.rows) - self.cursor)
+            batch_rows[filled:filled + count] \
+                = self.rows[self.cursor:self.cursor + count]
+            self.cursor += count
+            filled += count
+
+        return batch_rows
+
+    def next_batch(self, batch_size):
+        return self.dataset.take(self.next_rows(batch_size))
+
+
+class BatchAssembler(object):
+    '''
+    Assembles a batch where example i is drawn from generators[gen_indexes[i]]:
+    each distinct generator is asked once for all of its rows
+    [get_batch_iter(count)], which are scattered into preallocated batch
+    arrays. The arrays are reused by the next call.
+    '''
+    def __init__(self):
+        self.inputs = None
+        self.outputs = None
+
+    def _get_buffers(self, batch_size, inputs, outputs):
+        input_shape = (batch_size,) + inputs.shape[1:]
+        output_shape = (batch_size,) + outputs.shape[1:]
+        if self.inputs is None or self.inputs.shape != input_shape \
+           or self.inputs.dtype != inputs.dtype \
+           or self.outputs.shape != output_shape:
+            self.inputs = np.empty(input_shape, dtype=inputs.dtype)
+            self.outputs = np.empty(output_shape, dtype=outputs.dtype)
+
+        return self.inputs, self.outputs
+
+    def __call__(self, generators, gen_indexes):
+        gen_indexes = np.asarray(gen_indexes)
+        unique_gens, inverse = np.unique(gen_indexes, return_inverse=True)
+        inputs = outputs = None
+        for group, t in enumerate(unique_gens):
+            rows = np.flatnonzero(inverse == group)
+            images, labels = generators[t].get_batch_iter(len(rows))
+            labels = np.asarray(labels).reshape([len(rows), -1])  # as vstack
+            if inputs is None:
+                inputs, outputs = self._get_buffers(len(gen_indexes),
+                                                    images, labels)
+
+            inputs[rows] = images
+            outputs[rows] = labels
+
+        return inputs, outputs
+
+
+# one get_batch_iter per distinct generator, into a reused batch array
+BATCH_ASSEMBLER = BatchAssembler()
+
+
+def generate_from_index(generators, gen_indexes):
+    try:
+        inputs, outputs = BATCH_ASSEMBLER(generators, gen_indexes)
+        return inputs, outputs, gen_indexes
+    except Exception as e:
+        print 'caught exception in gen_from_index: ', e
+        print 'len generators = %d | t = %s' % (len(generators), str(np.unique(gen_indexes)))
+
+
+class Prefetcher(object):
+    '''
+    Runs batch assembly ahead of the training loop.
+
+    schedule_fn(state) -> (state, gen_indexes) is the [sequential] generator
+    switch logic; it runs in a feeder thread, which also assembles the
+    batches [BatchAssembler] into the slots of a ring buffer. A single
+    thread keeps the per class samplers of the generators in one state
+    [every row is drawn once per epoch] and nothing is forked from a
+    process that already holds a tf.Session; numpy releases the GIL while
+    gathering, so assembly still overlaps the training step. A slot is
+    only handed out again once the consumer moved on, so the feeder blocks
+    when the ring is full [backpressure]. get() returns the batches in
+    schedule order as (inputs, outputs, gen_indexes, state); the inputs /
+    outputs are valid until the next get(). Errors in the feeder are
+    raised by get().
+    '''
+    def __init__(self, generators, schedule_fn, state, num_slots=8):
+        # assemble the first batch synchronously to size the ring buffer
+        state, gen_indexes = schedule_fn(state)
+        self.assembler = BatchAssembler()
+        inputs, outputs = self.assembler(generators, gen_indexes)
+        self.inputs = np.empty((num_slots,) + inputs.shape, dtype=inputs.dtype)
+        self.outputs = np.empty((num_slots,) + outputs.shape,
+                                dtype=outputs.dtype)
+        self.inputs[0], self.outputs[0] = inputs, outputs
+
+        self.generators = generators
+        self.schedule_fn = schedule_fn
+        self.state = state
+        self.meta = {0: (gen_indexes, state)}
+        self.ready = {0: (0, None)}
+        self.next_seq = 0
+        self.current_slot = None
+        self.running = True
+        self.done = Queue()
+        self.free_slots = Queue()
+        for slot in range(1, num_slots):
+            self.free_slots.put(slot)
+
+        self.feeder = threading.Thread(target=self._feed)
+        self.feeder.daemon = True
+        self.feeder.start()
+
+    def _feed(self):
+        seq = 1
+        while self.running:
+            slot = self.free_slots.get()  # blocks while the ring is full
+            if slot is None:
+                break
+
+            try:
+                self.state, gen_indexes = self.schedule_fn(self.state)
+                self.meta[seq] = (gen_indexes, self.state)
+                inputs, outputs = self.assembler(self.generators, gen_indexes)
+                self.inputs[slot], self.outputs[slot] = inputs, outputs
+                self.done.put((seq, slot, None))
+            except Exception as e:
+                self.meta.setdefault(seq, (None, self.state))
+                self.done.put((seq, slot, repr(e)))
+                break  # the schedule can't be continued
+
+            seq += 1
+
+    def get(self):
+        if self.current_slot is not None:
+            self.free_slots.put(self.current_slot)
+
+        while self.next_seq not in self.ready:
+            seq, slot, error = self.done.get()
+            self.ready[seq] = (slot, error)
+
+        slot, error = self.ready.pop(self.next_seq)
+        gen_indexes, state = self.meta.pop(self.next_seq)
+        self.next_seq += 1
+        self.current_slot = slot
+        if error is not None:
+            raise Exception("prefetching failed: %s" % error)
+
+        return self.inputs[slot], self.outputs[slot], gen_indexes, state
+
+    def close(self):
+        self.running = False
+        self.free_slots.put(None)
+        self.feeder.join(1)
+
+
+def prefetch_train_data(generators, index_fn, num_train, batch_size, state):
+    ''' generate_train_data run ahead of training in a background thread;
+        index_fn(num_train, num_generators, state) -> (state, gen_indexes)
+        is the driver's create_indexes [trimmed to whole batches here];
+        get() returns (inputs, outputs, indexes, state) '''
+    def schedule(state):
+        state, indexes = index_fn(num_train, len(generators), state)
+        num_batches = int(np.floor(len(indexes) / batch_size))
+        return state, indexes[0:num_batches * batch_size]  # dump extra data
+
+    return Prefetcher(generators, schedule, state)
+
+
+def filter_splits(datasets, blacklist):
+    '''
+    Returns a shallow copy of a train / [validation] / test container
+    where every split is replaced by a DataSet.filter(blacklist) view.
+    '''
+    return Pipeline([Filter(blacklist)]).apply_splits(datasets)
+
+
+def _replace_splits(datasets, splits):
+    ''' shallow copy of a train / [validation] / test container '''
+    if hasattr(datasets, '_replace'):  # namedtuple
+        return datasets._replace(**splits)
+
+    replaced = copy(datasets)
+    for split, dataset in splits.items():
+        setattr(replaced, split, dataset)
+
+    return replaced
@@ -4,23 +4,87 @@ import tensorflow.contrib.slim as slim
 # from tensorflow.contrib.slim.nets import resnet_v2, resnet_utils
 
 
-def copy_layer(sess, src_layer, src_scope, dest_layer, dst_scope):
-    src_vars = [v for v in tf.global_variables()
-                if src_layer.scope in v.name and src_scope in v.name]
-    dest_vars = [v for v in tf.global_variables()
-                 if dest_layer.scope in v.name and dst_scope in v.name]
+def _layer_variables(variables, layer, scope):
+    '''
+    {key: variable} for the weights of layer under the model scope; the key
+    is the variable name relative to scope with the layer scope removed
+    [so that it matches across models]. BatchNorm & Adam vars are skipped.
+    '''
+    layer_scope = '/' + layer.scope + '/'
+    keyed = {}
+    for v in variables:
+        if not v.name.startswith(scope + '/') \
+           or 'BatchNorm' in v.name or 'Adam' in v.name:
+            continue
+
+        relative = v.name[len(scope):]
+        if layer_scope in relative:
+            keyed[relative.replace(layer_scope, '/', 1)] = v
+
+    return keyed
+
+
+# variable -> (placeholder, assign op), built once per variable [see copy_layer]
+_LOAD_OPS = {}
 
-    copy_ops = []
-    for s, d in zip(src_vars, dest_vars):
-        if ('BatchNorm' not in s.name or 'BatchNorm' not in d.name) \
-           and ('Adam' not in s.name or 'Adam' not in d.name):
-            if s.get_shape().as_list() == d.get_shape().as_list():
-                print 'copying %s [%s] --> %s [%s]' \
-                    % (s.name, s.get_shape().as_list(),
-                       d.name, d.get_shape().as_list())
-                copy_ops.append(d.assign(s))
 
-    sess.run(copy_ops)
+def _load_op(variable):
+    if variable not in _LOAD_OPS:
+        value = tf.placeholder(variable.dtype.base_dtype,
+                               variable.get_shape())
+        _LOAD_OPS[variable] = (value, variable.assign(value))
+
+    return _LOAD_OPS[variable]
+
+
+def copy_layer(sess, src_layer, src_scope, dest_layer, dst_scope,
+               src_vars=None, dest_vars=None, optimizers=None):
+    '''
+    Copies the weights of src_layer into dest_layer [matched by name, see
+    _layer_variables] with one read and one load of the session [the load
+    ops are cached per variable, see _load_op]. src_vars / dest_vars
+    restrict the search [eg: VAE.vae_vars], otherwise all global variables
+    are searched.
+    optimizers = (src_optimizer, dest_optimizer) also copies the slots
+    [eg: Adam moments] of every copied weight.
+
+    Returns the keys that were skipped because of a shape mismatch.
+    '''
+    src = _layer_variables(src_vars if src_vars is not None
+                           else tf.global_variables(), src_layer, src_scope)
+    dest = _layer_variables(dest_vars if dest_vars is not None
+                            else tf.global_variables(), dest_layer, dst_scope)
+
+    pairs, skipped = [], []
+    for key in sorted(set(src) & set(dest)):
+        s, d = src[key], dest[key]
+        if s.get_shape().as_list() == d.get_shape().as_list():
+            pairs.append((s, d))
+        else:
+            skipped.append(key)
+            print 'skipping %s [%s] --> %s [%s], shape mismatch' \
+                % (s.name, s.get_shape().as_list(),
+                   d.name, d.get_shape().as_list())
+
+    if optimizers is not None:
+        src_opt, dest_opt = optimizers
+        for s, d in list(pairs):
+            for name in src_opt.get_slot_names():
+                s_slot = src_opt.get_slot(s, name)
+                d_slot = dest_opt.get_slot(d, name)
+                if s_slot is not None and d_slot is not None:
+                    pairs.append((s_slot, d_slot))
+
+    if pairs:
+        values = sess.run([s for s, _ in pairs])
+        loads = [_load_op(d) for _, d in pairs]
+        sess.run([assign for _, assign in loads],
+                 feed_dict=dict((placeholder, value) for (placeholder, _), value
+                                in zip(loads, values)))
+
+    print 'copied %d variables from %s to %s, skipped %d' \
+        % (len(pairs), src_scope, dst_scope, len(skipped))
+    return skipped
 
 
 def reinit_last_layer(sess, dest_layer):
@@ -128,7 +192,9 @@ class CNNEncoder(object):
                              biases_initializer=tf.constant_initializer(0),
                              activation_fn=None, normalizer_fn=None)
             print('conv encoded final = ', h6.get_shape().as_list())
-            return tf.reshape(h6, [xshp[0], -1])
+            # [-1, ...]: the batch may only be known at run time
+            hshp = h6.get_shape().as_list()
+            return tf.reshape(h6, [-1, hshp[1] * hshp[2] * hshp[3]])
 
 class DenseEncoder(object):
     def __init__(self, sess, latent_size, is_training,
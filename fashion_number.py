@@ -1,15 +1,14 @@
 import os
-import cv2
 import numpy as np
 import tensorflow.contrib.keras as K
-from scipy.misc import imrotate as rotate
 from scipy.misc import imresize as imresize
+from scipy.ndimage import gaussian_filter
 from sklearn.preprocessing import StandardScaler
 
 
-from copy import deepcopy
-from utils import zip_filter_unzip
-from tensorflow.python.framework import dtypes
+from data_store import DataSet, load_or_build_store, filter_splits, \
+    resize_split, parallel_resize, rotate_split, rotate_batch, map_split, \
+    class_pipeline
 
 
 TRAIN_IMGS_URL = 'http://fashion-mnist.s3-website.eu-central-1.amazonaws.com/train-images-idx3-ubyte.gz'
@@ -31,19 +30,10 @@ class Fashion_Class(object):
         self.number = class_number  # the class to filter out
         self.blacklist = list(np.arange(11))  # remember: goes to 10
         self.blacklist.remove(self.number)
-        self.classes = self.filter_classes(fashion, self.blacklist)
 
-        # return images in [batch, row, col]
-        if not is_flat:
-            self.classes = Fashion_Class._unflatten_mnist(self.classes)
-
-        # resizes images if resize_dims tuple is provided
-        if resize_dims is not None:
-            self.classes = Fashion_Class.resize_mnist(self.classes, resize_dims)
-
-        # tile images as [img, img, img]
-        if convert_to_rgb:
-            self.classes = Fashion_Class.bw_to_rgb_mnist(self.classes)
+        # filter out all other classes, then [unflatten, resize, rgb]
+        self.classes = class_pipeline(self.blacklist, is_flat, resize_dims,
+                                      convert_to_rgb).apply_splits(fashion)
 
     @staticmethod
     def _unflatten_mnist(mnist):
@@ -53,23 +43,21 @@ class Fashion_Class(object):
 
     @staticmethod
     def resize_mnist(mnist, new_dims):
-        mnist.train._images = Fashion_Class.resize_images(mnist.train._images, new_dims)
-        mnist.test._images = Fashion_Class.resize_images(mnist.test._images, new_dims)
+        # resized once per split and cached, class views stay views
+        resize_split(mnist.train, new_dims)
+        resize_split(mnist.test, new_dims)
         return mnist
 
     @staticmethod
     def bw_to_rgb_mnist(mnist):
-        mnist.train._images = Fashion_Class.bw_to_rgb(mnist.train._images)
-        mnist.test._images = Fashion_Class.bw_to_rgb(mnist.test._images)
+        # pixels stay single channel uint8, rgb is broadcast per batch
+        mnist.train.to_rgb()
+        mnist.test.to_rgb()
         return mnist
 
-
     @staticmethod
     def resize_images(imgs, new_dims):
-        tuple_size = tuple(new_dims) if type(new_dims) == list else new_dims
-        return np.vstack([np.expand_dims(cv2.resize(img.reshape(28, 28),
-                                                    tuple_size), 0)
-                          for img in imgs])
+        return parallel_resize(imgs.reshape([-1, 28, 28]), list(new_dims))
 
         # return np.vstack([imresize(img.reshape(28, 28),
         #                            new_dims, mode='L',
@@ -78,71 +66,23 @@ class Fashion_Class(object):
 
     @staticmethod
     def bw_to_rgb(imgs):
-        return np.vstack([np.tile(img.reshape(img.shape[0], imgs.shape[1], 1), 3)
-                          .reshape(-1, img.shape[0], img.shape[1], 3)
-                          for img in imgs])
+        return np.repeat(imgs[..., np.newaxis], 3, axis=-1)
 
     @staticmethod
     def _rotate_batch(batch, angle):
-        return np.vstack([rotate(x_i.reshape(28, 28), angle).reshape([-1, 28*28])
-                          for x_i in batch])
-
-    @staticmethod
-    def _check_and_load_angle(angle, number, base_path='MNIST_data'):
-        ''' Returns None if the file doesn't exists'''
-        filename = os.path.join(base_path, "mnist_num%d_angle%d.hdf5"
-                                % (number, angle))
-        if os.path.exists(filename):
-            f = h5py.File(filename, "r")
-            return f['train'][()], f['test'][()]
-            # return f['train'], f['validation'], f['test']
-
-        return None
-
-    @staticmethod
-    def _check_and_write_angle(angle, number, mnist, base_path='MNIST_data'):
-        ''' serializes the rotated number to disk as a hdf5 file'''
-        filename = os.path.join(base_path, "mnist_num%d_angle%d.hdf5"
-                                % (number, angle))
-        if not os.path.exists(filename):
-            f = h5py.File(filename, "w")
-            f['train'] = mnist.train._images
-            f['test'] = mnist.test._images
-
-            print 'serialized %s to disk...' % filename
+        return rotate_batch(batch.reshape([-1, 28, 28]), angle).reshape(batch.shape)
 
     @staticmethod
     def rotate_all_sets(mnist, number, angle):
-        hpf5_load = Fashion_Class._check_and_load_angle(angle, number)
-        if hpf5_load is not None:
-            train_imgs = np.asarray(hpf5_load[0], np.float32)
-            test_imgs = np.asarray(hpf5_load[2], np.float32)
-        else:
-            train_imgs = Fashion_Class._rotate_batch(mnist.train._images, angle)
-            test_imgs = Fashion_Class._rotate_batch(mnist.test._images, angle)
-
-        mnist.train._images = train_imgs
-        mnist.test._images = test_imgs
-
-        Fashion_Class._check_and_write_angle(angle, number, mnist)
+        # all angles live in one rotation store, each set is a lazy slice
+        rotate_split(mnist.train, angle)
+        rotate_split(mnist.test, angle)
         return mnist
 
     @staticmethod
     def filter_classes(fashion, blacklist):
-        classes = deepcopy(fashion)
-        classes.train._images, classes.train._labels = zip_filter_unzip(classes.train._images,
-                                                                        classes.train._labels,
-                                                                        blacklist)
-        classes.train._images = np.array(classes.train._images)
-        classes.train._labels = np.array(classes.train._labels)
-        classes.train._num_examples = len(classes.train.images)
-        classes.test._images, classes.test._labels = zip_filter_unzip(classes.test._images,
-                                                                      classes.test._labels,
-                                                                      blacklist)
-        classes.test._images = np.array(classes.test._images)
-        classes.test._labels = np.array(classes.test._labels)
-        classes.test._num_examples = len(classes.test.images)
-        return classes
+        ''' index views over the shared splits, nothing is copied '''
+        return filter_splits(fashion, blacklist)
 
     # if one vs. all then 0 = true class, 1 = other
     # otherwise we just use lbl = lbl,  10 = other
@@ -165,131 +105,22 @@ class Fashion_Class(object):
         return np.array(images), np.array(labels)
 
     def get_test_batch_iter(self, batch_size):
-        images = []; labels = []; count = 0
-        while(count < batch_size):
-            max_batch = self.classes.test._num_examples
-            im, lbl = self._get_test_batch_iter(max_batch)
-            tar = self.number
-            if tar in lbl:
-                im, lbl = zip_filter_unzip(im, lbl, self.blacklist)
-                count += len(im)
-                #  im = np.asarray(im); lbl = np.asarray(lbl); count += len(lbl)
-                images.append(im); labels.append(lbl)
-
-        return np.vstack(images)[0:batch_size], np.hstack(labels)[0:batch_size]
+        # only the test examples of our class
+        return self.classes.test.class_sampler([self.number]).next_batch(batch_size)
 
     def get_batch_iter(self, batch_size):
-        images = []; labels = []; count = 0
-        while(count < batch_size):
-            im, lbl = self.get_train_batch_iter(batch_size)
-            tar = self.number
-            if tar in lbl:
-                # im, lbl = zip_filter_unzip(im, lbl, self.blacklist)
-                im = np.asarray(im); lbl = np.asarray(lbl); count += len(lbl)
-                images.append(im); labels.append(lbl)
-
-        return np.vstack(images)[0:batch_size], np.hstack(labels)[0:batch_size]
-
-
-class DataSet(object):
-    def __init__(self,
-                 images,
-                 labels,
-                 one_hot=False,
-                 dtype=dtypes.float32,
-                 normalize=False):
-        """Construct a DataSet.
-        one_hot arg is used only if fake_data is true.  `dtype` can be either
-        `uint8` to leave the input as `[0, 255]`, or `float32` to rescale into
-        `[0, 1]`.
-        """
-        dtype = dtypes.as_dtype(dtype).base_dtype
-        if dtype not in (dtypes.uint8, dtypes.float32):
-            raise TypeError('Invalid image dtype %r, expected uint8 or float32' %
-                            dtype)
-        assert images.shape[0] == labels.shape[0], (
-            'images.shape: %s labels.shape: %s' % (images.shape, labels.shape))
-        self._num_examples = images.shape[0]
-
-        if dtype == dtypes.float32:
-            # Convert from [0, 255] -> [0.0, 1.0].
-            images = images.astype(np.float32)
-            if normalize:
-                images = np.multiply(images, 1.0 / 255.0)
-
-        self._images = images
-        self._labels = labels
-        self._epochs_completed = 0
-        self._index_in_epoch = 0
-
-    @property
-    def images(self):
-        return self._images
-
-    @property
-    def labels(self):
-        return self._labels
-
-    @property
-    def num_examples(self):
-        return self._num_examples
-
-    @property
-    def epochs_completed(self):
-        return self._epochs_completed
-
-    def next_batch(self, batch_size, fake_data=False, shuffle=True):
-        """Return the next `batch_size` examples from this data set."""
-        start = self._index_in_epoch
-
-        # Shuffle for the first epoch
-        if self._epochs_completed == 0 and start == 0 and shuffle:
-            perm0 = np.arange(self._num_examples)
-            np.random.shuffle(perm0)
-            self._images = self.images[perm0]
-            self._labels = self.labels[perm0]
-
-        # Go to the next epoch
-        if start + batch_size > self._num_examples:
-            # Finished epoch
-            self._epochs_completed += 1
-
-            # Get the rest examples in this epoch
-            rest_num_examples = self._num_examples - start
-            images_rest_part = self._images[start:self._num_examples]
-            labels_rest_part = self._labels[start:self._num_examples]
-
-            # Shuffle the data
-            if shuffle:
-                perm = np.arange(self._num_examples)
-                np.random.shuffle(perm)
-                self._images = self.images[perm]
-                self._labels = self.labels[perm]
-
-            # Start next epoch
-            start = 0
-            self._index_in_epoch = batch_size - rest_num_examples
-            end = self._index_in_epoch
-            images_new_part = self._images[start:end]
-            labels_new_part = self._labels[start:end]
-            return [np.concatenate((images_rest_part, images_new_part), axis=0),
-                    np.concatenate((labels_rest_part, labels_new_part), axis=0)]
-        else:
-            self._index_in_epoch += batch_size
-            end = self._index_in_epoch
-            return self._images[start:end], self._labels[start:end]
+        return self.classes.train.class_sampler([self.number]).next_batch(batch_size)
+
 
 class Fashion:
     def __init__(self, one_hot, path='Fashion_data'):
         # (x_train, y_train), (x_test, y_test) = K.datasets.fashion.load_data()
-        self.download(path)
-        x_train, y_train = self.load_mnist(path, kind='train')
-        # x_train = x_train.reshape(-1, 28, 28)
-        x_test, y_test = self.load_mnist(path, kind='t10k')
-        # x_test = x_test.reshape(-1, 28, 28)
-
-        self.train = DataSet(x_train, y_train, one_hot)
-        self.test = DataSet(x_test, y_test, one_hot)
+        splits = load_or_build_store('fashion', ['train', 'test'],
+                                     lambda: self._build_store(path))
+        self.train = DataSet(*splits['train'], one_hot=one_hot,
+                             store_key=('fashion', 'train'))
+        self.test = DataSet(*splits['test'], one_hot=one_hot,
+                            store_key=('fashion', 'test'))
 
         # XXX: for compatibility
         self.number = 9996
@@ -298,6 +129,14 @@ class Fashion:
         images, labels = self.train.next_batch(batch_size)
         return np.array(images), np.array(labels)
 
+    def _build_store(self, path):
+        ''' downloads & gunzips the idx files as raw uint8 [only run once] '''
+        self.download(path)
+        x_train, y_train = self.load_mnist(path, kind='train')
+        x_test, y_test = self.load_mnist(path, kind='t10k')
+        return {'train': (x_train, y_train),
+                'test': (x_test, y_test)}
+
     @staticmethod
     def normalize_imgs(imgs_train, imgs_test):
         imgs_train_scaled = imgs_train / 255.
@@ -419,13 +258,37 @@ def scale(val, src, dst):
     return ((val - src[0]) / (src[1]-src[0])) * (dst[1]-dst[0]) + dst[0]
 
 
-# Read mnist only once [~ 230Mb]
+def _adaptive_threshold_chunk(args):
+    ''' cv2.adaptiveThreshold [ADAPTIVE_THRESH_GAUSSIAN_C, THRESH_BINARY]
+        over the stacked chunk at once: a pixel is set if it exceeds the
+        gaussian weighted mean of its block_size neighbourhood minus C '''
+    images, block_size, C = args
+    square = images.reshape([-1, 28, 28]).astype(np.float32)
+
+    # cv2's kernel [sigma from block_size] and replicated borders,
+    # the mean is rounded back to uint8 as in cv2
+    sigma = 0.3 * ((block_size - 1) * 0.5 - 1) + 0.8
+    mean = gaussian_filter(square, sigma=(0, sigma, sigma), mode='nearest',
+                           truncate=((block_size - 1) // 2) / sigma)
+    binary = square > np.round(mean) - np.ceil(C)
+    return (binary * 255).astype(images.dtype).reshape(images.shape)
+
+
+# the stage version of _adaptive_threshold_chunk [see map_split]
+ADAPTIVE_THRESHOLD_VERSION = 2
+
+
+def adaptive_threshold_split(dataset, block_size=21, C=0):
+    ''' gaussian adaptive thresholding of a split, cached per (block_size, C) '''
+    return map_split(dataset, "adaptive_threshold",
+                     _adaptive_threshold_chunk, (block_size, C),
+                     version=ADAPTIVE_THRESHOLD_VERSION)
+
+
+# Open fashion only once [memory-mapped uint8, shared across processes]
 fashion = Fashion(one_hot=False)
 
 # Dense
-fashion.train._images = fashion.train._images.reshape([-1, 28, 28]).astype(np.uint8)
-fashion.test._images = fashion.test._images.reshape([-1, 28, 28]).astype(np.uint8)
-
 ################ Method: OTSU #############
 # train = []
 # for img in fashion.train._images:
@@ -443,20 +306,11 @@ fashion.test._images = fashion.test._images.reshape([-1, 28, 28]).astype(np.uint
 ###########################################
 
 ######### Method: adaptive thresholding ###############
-fashion.train._images = np.vstack([cv2.adaptiveThreshold(img, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,\
-                                                         cv2.THRESH_BINARY, 21, 0) for img in fashion.train._images])
-fashion.test._images = np.vstack([cv2.adaptiveThreshold(img, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,\
-                                                        cv2.THRESH_BINARY, 21, 0) for img in fashion.test._images])
-
-fashion.train._images = fashion.train._images.reshape([-1, 28*28]).astype(np.float32)
-fashion.test._images = fashion.test._images.reshape([-1, 28*28]).astype(np.float32)
-fashion.train._images /= 255.0
-fashion.test._images /= 255.0
-print("POST")
-print("fashion train min = ", np.min(fashion.train._images))
-print("fashion train max = ", np.max(fashion.train._images))
-print("fashion test min = ", np.min(fashion.test._images))
-print("fashion test max = ", np.max(fashion.test._images))
+# thresholded once on a process pool and cached as a stage store,
+# afterwards this [and eg: the resize_split 32x32 variant] is a cheap open;
+# kept as uint8, DataSet rescales into [0, 1] per batch
+adaptive_threshold_split(fashion.train, 21, 0)
+adaptive_threshold_split(fashion.test, 21, 0)
 print("fashion shape = ", fashion.train._images.shape)
 #########################################################
 
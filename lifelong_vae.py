@@ -1,6 +1,6 @@
 import os
-import sys
 import datetime
+import threading
 import numpy as np
 import tensorflow as tf
 import tensorflow.contrib.slim as slim
@@ -13,13 +13,17 @@ from utils import *
 
 sg = tf.contrib.bayesflow.stochastic_graph
 st = tf.contrib.bayesflow.stochastic_tensor
-sys.setrecursionlimit(200)
 
 # Global variables
 GLOBAL_ITER = 0  # keeps track of the iteration ACROSS models
 TRAIN_ITER = 0  # the iteration of the current model
 
 
+def default_current_fraction(total_true_models):
+    ''' fraction of each batch kept as current data [rest is replayed] '''
+    return 1.0/(total_true_models + 1.0)
+
+
 class VAE(object):
     """ Online Variational Autoencoder with consistent sampling.
 
@@ -34,14 +38,49 @@ class VAE(object):
                  reconstr_loss_type="binary_cross_entropy", learning_rate=1e-4,
                  submodel=0, total_true_models=0, vae_tm1=None,
                  p_x_given_z_func=distributions.Bernoulli,
-                 base_dir=".", mutual_info_reg=0.0, img_shape=[28, 28, 1]):
-        self.x = x
+                 base_dir=".", mutual_info_reg=0.0, img_shape=[28, 28, 1],
+                 augment=None, input_queue=None, release_ancestors=False,
+                 replay_size=0, replay_every=500,
+                 current_fraction=default_current_fraction,
+                 carry_optimizer=False, warmup_steps=0):
+        # the scope name is built once [see get_name]; only the variables
+        # created past these collection offsets can belong to this model
+        self.scope_name = None
+        self.collection_offsets = dict(
+            (key, len(tf.get_collection_ref(key)))
+            for key in [tf.GraphKeys.GLOBAL_VARIABLES,
+                        tf.GraphKeys.LOCAL_VARIABLES,
+                        tf.GraphKeys.TRAINABLE_VARIABLES])
+
+        # x is what gets fed [or dequeued, see utils.QueueInput]; self.x is
+        # the [optionally] graph-augmented batch [see utils.GraphAugment],
+        # shared with the ancestor on forks
+        self.x_input = x
+        self.augment = augment
+        self.input_queue = input_queue
+        if vae_tm1 is not None and vae_tm1.x_input is x:
+            self.x = vae_tm1.x
+        elif augment is not None:
+            self.x = augment(x)
+        else:
+            self.x = x
+
         self.activation = activation
         self.learning_rate = learning_rate
         self.is_training = is_training
         self.encoder_model = encoder
         self.decoder_model = decoder
         self.vae_tm1 = vae_tm1
+        self.vae_tm1_name = vae_tm1.get_name() if vae_tm1 is not None \
+            else None
+        self.release_ancestors = release_ancestors
+        self.is_frozen = False
+        self.replay_size = replay_size  # 0: the teacher runs every step
+        self.replay_every = replay_every
+        self.current_fraction = current_fraction  # f(total_true_models)
+        self.carry_optimizer = carry_optimizer  # fork keeps Adam's moments
+        self.warmup_steps = warmup_steps  # 0: no learning rate warm-up
+        self.replay_thread = None
         self.p_x_given_z_func = p_x_given_z_func
         self.global_iter_base = GLOBAL_ITER
         self.input_size = input_size
@@ -60,7 +99,6 @@ class VAE(object):
 
         # gumbel params
         self.tau0 = 1.0
-        self.tau_host = self.tau0
         self.anneal_rate = 0.00003
         # self.anneal_rate = 0.0003 #1e-5
         self.min_temp = 0.5
@@ -89,11 +127,17 @@ class VAE(object):
         # self.check_op = tf.add_check_numerics_ops()
 
         # collect variables & build saver
-        self.vae_vars = [v for v in tf.global_variables()
-                         if v.name.startswith(self.get_name())]
-        self.vae_local_vars = [v for v in tf.local_variables()
-                               if v.name.startswith(self.get_name())]
-        self.saver = tf.train.Saver(tf.global_variables())  # XXX: use local
+        self.registry = self._create_registry()
+        self.vae_vars = self.registry['global']
+        self.vae_local_vars = self.registry['local']
+        if release_ancestors:
+            # older ancestors are released on fork [see _freeze_as_teacher]
+            saver_vars = self.vae_vars + (vae_tm1._teacher_variables()
+                                          if vae_tm1 is not None else [])
+            self.saver = tf.train.Saver(saver_vars)
+            self._create_release_ops()
+        else:
+            self.saver = tf.train.Saver(tf.global_variables())  # XXX: use local
         self.init_op = tf.variables_initializer(self.vae_vars
                                                 + self.vae_local_vars)
 
@@ -133,13 +177,36 @@ class VAE(object):
             # else:
             #     self.x = self.vae_tm1.x
 
-            # gpu iteration count
-            self.iteration_gpu = tf.Variable(0.0, trainable=False)
-            self.iteration_gpu_op = self.iteration_gpu.assign_add(1.0)
-
-            # gumbel related
-            self.tau = tf.Variable(5.0, trainable=False, dtype=tf.float32,
-                                   name="temperature")
+            # gpu iteration count [a fork continues from its ancestor's]
+            iteration_init = self.vae_tm1.iteration_gpu \
+                if self.vae_tm1 is not None else 0.0
+            self.iteration_gpu = tf.Variable(iteration_init, trainable=False)
+            iteration = self.iteration_gpu.read_value()
+
+            # learning rate, linearly warmed up over warmup_steps from the
+            # iteration this model started at [ie: after every fork]
+            self.iteration_start = tf.Variable(iteration_init, trainable=False)
+            if self.warmup_steps > 0:
+                warmup = (iteration - self.iteration_start + 1.0) \
+                    / float(self.warmup_steps)
+                self.learning_rate_t = tf.multiply(self.learning_rate,
+                                                   tf.minimum(warmup, 1.0),
+                                                   name="learning_rate")
+            else:
+                self.learning_rate_t = tf.constant(self.learning_rate,
+                                                   name="learning_rate")
+
+            # gumbel related: annealed every 10 train steps, ie:
+            # max(tau0 * exp(-anneal_rate * step), min_temp)
+            anneal_step = tf.floor(iteration / 10.0) * 10.0
+            self.tau = tf.maximum(self.tau0 * tf.exp(-self.anneal_rate
+                                                     * anneal_step),
+                                  self.min_temp, name="temperature")
+
+            # the step increments only after tau & the learning rate were
+            # computed, so a train step always sees the pre-step iteration
+            with tf.control_dependencies([self.tau, self.learning_rate_t]):
+                self.iteration_gpu_op = self.iteration_gpu.assign_add(1.0)
             # self.ema = tf.train.ExponentialMovingAverage(decay=0.9999)
 
     '''
@@ -154,7 +221,7 @@ class VAE(object):
                      tf.summary.scalar("vae_grad_norm", self.grad_norm),
                      tf.summary.scalar("bits_per_dim", self.generate_bits_per_dim()),
                      tf.summary.scalar("vae_selected_class", tf.argmax(tf.reduce_sum(self.z_pre_gumbel, 0), 0)),
-                     tf.summary.scalar("vae_selected_class_xtm1", tf.argmax(tf.reduce_sum(self.z_pre_gumbel[self.num_current_data:], 0), 0)),
+                     tf.summary.scalar("vae_selected_class_xtm1", tf.argmax(tf.reduce_sum(self._replayed(self.z_pre_gumbel), 0), 0)),
                      tf.summary.histogram("vae_kl_normal", self.kl_normal),
                      tf.summary.histogram("vae_kl_discrete", self.kl_discrete),
                      tf.summary.histogram("vae_latent_dist", self.latent_kl),
@@ -163,6 +230,8 @@ class VAE(object):
                      tf.summary.scalar("vae_reconstr_loss_mean", self.reconstr_loss_mean),
                      tf.summary.scalar("vae_reconstr_loss_max", tf.reduce_max(self.reconstr_loss)),
                      tf.summary.scalar("vae_reconstr_loss_min", tf.reduce_min(self.reconstr_loss)),
+                     tf.summary.scalar("vae_gumbel_tau", self.tau),
+                     tf.summary.scalar("vae_learning_rate", self.learning_rate_t),
                      tf.summary.histogram("z_dist", self.z)]
 
         # Display image summaries : i.e. samples from P(X|Z=z_i)
@@ -196,7 +265,7 @@ class VAE(object):
             with tf.variable_scope(self.get_name()):  # accuracy operator
                 # selected_classes_for_xtm1 = tf.argmax(self.z_discrete[self.num_current_data:], 0)
                 # selected_classes_by_vae_tm1 = tf.argmax(self.q_z_t_given_x_t, 0)
-                selected_classes_for_xtm1 = self.z_pre_gumbel[self.num_current_data:]  # self.z_discrete[self.num_current_data:]
+                selected_classes_for_xtm1 = self._replayed(self.z_pre_gumbel)  # self.z_discrete[self.num_current_data:]
                 selected_classes_by_vae_tm1 = self.q_z_t_given_x_t
                 correct_prediction = tf.equal(tf.argmax(selected_classes_by_vae_tm1, 1),
                                               tf.argmax(selected_classes_for_xtm1, 1))
@@ -204,7 +273,7 @@ class VAE(object):
 
             num_xhat_tm1 = self.xhat_tm1.get_shape().as_list()
             image_summaries += [tf.summary.image("xhat_tm1",
-                                                 tf.reshape(self.xhat_tm1, img_shp),
+                                                 tf.reshape(self.xhat_tm1, [-1] + self.img_shape),
                                                  max_outputs=num_xhat_tm1[0])]
             summaries += [tf.summary.scalar("vae_tm1_selected_class", tf.argmax(tf.reduce_sum(self.q_z_t_given_x_t, 0), 0)),
                           tf.summary.scalar("consistency_accuracy", self.accuracy),
@@ -238,6 +307,12 @@ class VAE(object):
     A helper function to format the name as a function of the hyper-parameters
     '''
     def get_name(self):
+        if self.scope_name is None:  # forks never rename a built model
+            self.scope_name = self._build_name()
+
+        return self.scope_name
+
+    def _build_name(self):
         if self.submodel == 0:
             full_hash_str = self.activation.__name__ \
                             + '_enc' + str(self.encoder_model.get_sizing()) \
@@ -259,9 +334,8 @@ class VAE(object):
                                                          .replace('\'', '')
             return 'vae%d_' % self.submodel + full_hash_str
         else:
-            vae_tm1_name = self.vae_tm1.get_name()
-            indexof = vae_tm1_name.find('_')
-            return 'vae%d_' % self.submodel + vae_tm1_name[indexof+1:]
+            indexof = self.vae_tm1_name.find('_')
+            return 'vae%d_' % self.submodel + self.vae_tm1_name[indexof+1:]
 
     def get_formatted_datetime(self):
         return str(datetime.datetime.now()).replace(" ", "_") \
@@ -339,16 +413,18 @@ class VAE(object):
             # This is necessary because we need to evaluate the posterior
             # in order to compare Q^T(x|z) against Q^S(x|z)
             # Note2: discrete dimension is self.submodel - 1 [possibly?]
-            rnd_sample = self.rnd_sample[:, 0:self.vae_tm1.num_discrete]
-            _, _, _, self.q_z_t_given_x_t, _, _ \
-                = self.vae_tm1.encoder(self.xhat_tm1,
-                                       rnd_sample=rnd_sample,
-                                       hard=False,  # True?
-                                       reuse=True)
+            if hasattr(self, 'q_z_t_replay'):  # cached with xhat_tm1
+                self.q_z_t_given_x_t = self.q_z_t_replay
+            else:
+                rnd_sample = self.rnd_sample[self.num_current_data:,
+                                             0:self.vae_tm1.num_discrete]
+                _, _, _, self.q_z_t_given_x_t, _, _ \
+                    = self.vae_tm1.encoder(self.xhat_tm1,
+                                           rnd_sample=rnd_sample,
+                                           hard=False,  # True?
+                                           reuse=True)
 
             # Get the number of gaussians for student and teacher
-            # We also only consider num_old_data of the batch
-            self.q_z_t_given_x_t = self.q_z_t_given_x_t[0:self.num_old_data]
             self.q_z_s_given_x_t, self.q_z_t_given_x_t \
                 = VAE.zero_pad_smaller_cat(self.q_z_s_given_x_t,
                                            self.q_z_t_given_x_t)
@@ -402,8 +478,8 @@ class VAE(object):
                                       self.tau, hard=hard,
                                       rnd_sample=rnd_sample)
 
-    def generator(self, Z, reuse=False):
-        with tf.variable_scope(self.get_name() + "/generator", reuse=reuse):
+    def generator(self, Z, reuse=False, scope="generator"):
+        with tf.variable_scope(self.get_name() + "/" + scope, reuse=reuse):
             print 'generator scope: ', tf.get_variable_scope().name
             logits = forward(Z, self.decoder_model)
 
@@ -438,9 +514,9 @@ class VAE(object):
         def _train():
             if hasattr(self, 'xhat_tm1'):  # make sure we have forked
                 # zero pad the current data on the bottom and add to
-                # the data we generated in _generate_vae_tm1_data()
+                # the num_old_data rows generated in _generate_vae_tm1_data()
                 full_data = [self.x[0:self.num_current_data],
-                             self.xhat_tm1[0:self.num_old_data]]
+                             self.xhat_tm1]
                 combined = tf.concat(axis=0, values=full_data,
                                      name="current_data")
             else:
@@ -472,11 +548,19 @@ class VAE(object):
         p_x_given_z_tm1 = vae_tm1.generator(z, reuse=True)
         return [z, z_cat, p_x_given_z_tm1.mean()]
 
+    def _num_current_rows(self, num_instances):
+        '''
+        rows of num_instances kept as current data [see current_fraction];
+        only called with a teacher, so at least one row is always replayed
+        '''
+        fraction = min(max(self.current_fraction(self.total_true_models), 0.0),
+                       1.0)
+        return min(int(fraction * float(num_instances)), num_instances - 1)
+
     def _generate_vae_tm1_data(self):
         if self.vae_tm1 is not None:
             num_instances = self.x.get_shape().as_list()[0]
-            self.num_current_data = int((1.0/(self.total_true_models + 1.0))
-                                        * float(num_instances))
+            self.num_current_data = self._num_current_rows(num_instances)
             self.num_old_data = num_instances - self.num_current_data
             # TODO: Remove debug trace
             print 'total instances: %d | current_model: %d | current_true_models: %d | current data number: %d | old data number: %d'\
@@ -487,13 +571,71 @@ class VAE(object):
                 # generate data by randomly sampling a categorical for
                 # N-1 positions; also sample a N(0, I) in order to
                 # generate variability
-                self.z_tm1, self.z_discrete_tm1, self.xhat_tm1 \
-                    = self.generate_at_least(self.vae_tm1,
-                                             self.batch_size)
+                if self.replay_size > 0:
+                    self._create_replay_buffer()
+                else:
+                    self.z_tm1, self.z_discrete_tm1, self.xhat_tm1 \
+                        = self.generate_at_least(self.vae_tm1,
+                                                 self.num_old_data)
 
                 print 'z_tm1 = ', self.z_tm1.get_shape().as_list(), \
                     '| xhat_tm1 = ', self.xhat_tm1.get_shape().as_list()
 
+    def _create_replay_buffer(self):
+        '''
+        The teacher generates replay_size rows of (z, z_cat, xhat_tm1,
+        q_z_t_given_x_t) in one batched pass [replay_refresh_op, see
+        refresh_replay]; every step gathers batch_size random rows of it
+        instead of running the teacher generator and encoder.
+        '''
+        z, z_cat, xhat = self.generate_at_least(self.vae_tm1,
+                                                self.replay_size)
+        _, _, _, q_z_t, _, _ = self.vae_tm1.encoder(xhat, hard=False,
+                                                    reuse=True)
+        generated = [z, z_cat, xhat, q_z_t]
+        with tf.variable_scope(self.get_name() + "/replay"):
+            self.replay_buffers = [tf.Variable(tf.zeros(shp(t)),
+                                               trainable=False, name=name)
+                                   for t, name in zip(generated,
+                                                      ["z", "z_cat", "xhat",
+                                                       "q_z_t"])]
+
+        self.replay_refresh_op = tf.group(*[b.assign(t) for b, t
+                                            in zip(self.replay_buffers,
+                                                   generated)])
+        rows = tf.random_uniform([self.num_old_data], minval=0,
+                                 maxval=self.replay_size, dtype=tf.int32)
+        self.z_tm1, self.z_discrete_tm1, self.xhat_tm1, self.q_z_t_replay \
+            = [tf.gather(b, rows) for b in self.replay_buffers]
+
+    def refresh_replay(self, block=False):
+        ''' regenerates the replay buffer [on a background thread] '''
+        if not hasattr(self, 'replay_refresh_op'):
+            return
+
+        if self.replay_thread is not None and self.replay_thread.is_alive():
+            return  # still refreshing
+
+        def _refresh():
+            self.sess.run(self.replay_refresh_op,
+                          feed_dict={self.is_training: False})
+
+        if block:
+            _refresh()
+        else:
+            self.replay_thread = threading.Thread(target=_refresh)
+            self.replay_thread.daemon = True
+            self.replay_thread.start()
+
+    def _maybe_refresh_replay(self):
+        if self.replay_every > 0 and self.iteration > 0 \
+           and self.iteration % self.replay_every == 0:
+            self.refresh_replay()
+
+    def _replayed(self, t):
+        ''' the rows of t that belong to the data generated by vae_tm1 '''
+        return t[self.num_current_data:]
+
     @staticmethod
     def _z_to_one_hot(z, latent_size):
         indices = tf.arg_max(z, 1)
@@ -664,15 +806,48 @@ class VAE(object):
 
             # construct our optimizer
             #with tf.control_dependencies([self.p_x_given_z_logits]):
-            filtered = [v for v in tf.trainable_variables()
-                        if v.name.startswith(self.get_name())]
+            filtered = self._trainable_variables()
             self.optimizer = self._create_optimizer(filtered,
                                                     self.cost_mean,
-                                                    self.learning_rate)
+                                                    self.learning_rate_t)
+
+            # train steps that also keep the running sum of
+            # [cost, elbo, recon, latent] on the graph [see partial_fit_n]
+            losses = tf.stack([self.cost_mean, self.elbo_mean,
+                               self.reconstr_loss_mean,
+                               self.latent_loss_mean])
+            self.fit_losses = tf.Variable(tf.zeros([4]), trainable=False,
+                                          name="fit_losses")
+            with tf.control_dependencies([self.optimizer,
+                                          self.iteration_gpu_op]):
+                self.fit_first_step = self.fit_losses.assign(losses)
+                self.fit_next_step = self.fit_losses.assign_add(losses)
+
+    def _own_variables(self, key):
+        ''' variables in collection key created while building this model '''
+        created = tf.get_collection_ref(key)[self.collection_offsets[key]:]
+        return [v for v in created if v.name.startswith(self.get_name())]
+
+    def _create_registry(self):
+        '''
+        The variables of this model, grouped once after it is built:
+        global, local, trainable and the optimizer slots of the trainables
+        '''
+        trainable = self._trainable_variables()
+        slots = [self.adam.get_slot(v, name) for v in trainable
+                 for name in self.adam.get_slot_names()]
+        return {'global': self._own_variables(tf.GraphKeys.GLOBAL_VARIABLES),
+                'local': self._own_variables(tf.GraphKeys.LOCAL_VARIABLES),
+                'trainable': trainable,
+                'slots': [slot for slot in slots if slot is not None]}
+
+    def _trainable_variables(self):
+        return self._own_variables(tf.GraphKeys.TRAINABLE_VARIABLES)
 
     def _create_optimizer(self, tvars, cost, lr):
         # optimizer = tf.train.rmspropoptimizer(self.learning_rate)
         optimizer = tf.train.AdamOptimizer(learning_rate=lr)
+        self.adam = optimizer  # its slots go to the registry
 
         print 'there are %d trainable vars in cost %s\n' % (len(tvars), cost.name)
         grads = tf.gradients(cost, tvars)
@@ -691,28 +866,28 @@ class VAE(object):
 
     def partial_fit(self, inputs, iteration_print=10,
                     iteration_save_imgs=2000,
-                    is_forked=False, summary="train"):
+                    is_forked=False, summary="train", angles=None):
         """Train model based on mini-batch of input data.
 
         Return cost of mini-batch.
         """
 
-        feed_dict = {self.x: inputs,
-                     self.is_training: True if summary == "train" else False,
-                     self.tau: self.tau_host}
+        feed_dict = {self.is_training: True if summary == "train" else False}
+        if inputs is not None:  # else dequeued from self.input_queue
+            feed_dict[self.x_input] = inputs
+        if self.augment is not None and angles is not None:
+            feed_dict.update(self.augment.feed(angles))
+
         if summary == "train":
             writer = self.train_summary_writer
         else:
             writer = self.test_summary_writer
 
-        try:
-            # update tau for gumbel-softmax
-            if summary == "train" and self.iteration > 0 and self.iteration % 10 == 0:
-                rate = -self.anneal_rate*self.iteration
-                self.tau_host = np.maximum(self.tau0 * np.exp(rate),
-                                           self.min_temp)
-                print 'updated tau to ', self.tau_host
+        if summary == "train":
+            self._maybe_refresh_replay()
 
+        cost = elbo = rloss = lloss = np.nan  # if the step fails
+        try:
             # full list of session ops
             ops_to_run = [self.cost_mean, self.elbo_mean,
                           self.reconstr_loss_mean,
@@ -762,6 +937,63 @@ class VAE(object):
         self.iteration += 1
         return cost, elbo, rloss, lloss
 
+    def partial_fit_n(self, inputs, num_steps, iteration_print=10,
+                      iteration_save_imgs=2000, is_forked=False,
+                      angles=None):
+        """Train model on num_steps consecutive mini-batches.
+
+        inputs [and angles] hold num_steps batches back to back, or are
+        None when dequeued from self.input_queue. The losses are summed on
+        the graph and fetched once; summaries keep the partial_fit cadence.
+
+        Return the mean cost, elbo, recon & latent loss over the steps
+        [over the completed ones if a step fails; NaN if none completed,
+        as partial_fit].
+        """
+        try:
+            for step in range(num_steps):
+                self._maybe_refresh_replay()
+                feed_dict = {self.is_training: True}
+                begin, end = step * self.batch_size, (step + 1) * self.batch_size
+                if inputs is not None:
+                    feed_dict[self.x_input] = inputs[begin:end]
+                if self.augment is not None and angles is not None:
+                    feed_dict.update(self.augment.feed(angles[begin:end]))
+
+                fit_step = self.fit_first_step if step == 0 \
+                    else self.fit_next_step
+                if iteration_save_imgs > 0 and self.iteration % iteration_save_imgs == 0:
+                    summary_op = self.image_summaries
+                elif self.iteration % iteration_print == 0:
+                    summary_op = self.summaries
+                else:
+                    summary_op = None
+
+                if summary_op is not None:
+                    losses, summary = self.sess.run([fit_step, summary_op],
+                                                    feed_dict=feed_dict)
+                    self.train_summary_writer.add_summary(summary,
+                                                          self.iteration)
+                elif step == num_steps - 1:
+                    losses = self.sess.run(fit_step, feed_dict=feed_dict)
+                else:
+                    # only the last step has to fetch anything
+                    self.sess.run(fit_step.op, feed_dict=feed_dict)
+
+                self.iteration += 1
+
+        except Exception as e:
+            print 'caught exception in partial fit: ', e
+            if step == 0:
+                return np.nan, np.nan, np.nan, np.nan  # nothing was trained
+
+            # the completed steps are already summed in fit_losses
+            losses = self.sess.run(self.fit_losses)
+            num_steps = step
+
+        cost, elbo, rloss, lloss = losses / float(num_steps)
+        return cost, elbo, rloss, lloss
+
     def write_classes_to_file(self, filename, all_classes):
         with open(filename, 'a') as f:
             np.savetxt(f, self.sess.run(all_classes), delimiter=",")
@@ -822,7 +1054,7 @@ class VAE(object):
         print 'encoder = ', encoder.get_info()
         print 'decoder = ', decoder.get_info()
 
-        vae_tp1 = VAE(self.sess, self.x,
+        vae_tp1 = VAE(self.sess, self.x_input,
                       input_size=self.input_size,
                       batch_size=self.batch_size,
                       latent_size=self.latent_size,
@@ -837,28 +1069,132 @@ class VAE(object):
                       total_true_models=self.total_true_models+num_new_class,
                       vae_tm1=self,
                       img_shape=self.img_shape,
+                      augment=self.augment,
+                      input_queue=self.input_queue,
+                      release_ancestors=self.release_ancestors,
+                      replay_size=self.replay_size,
+                      replay_every=self.replay_every,
+                      current_fraction=self.current_fraction,
+                      carry_optimizer=self.carry_optimizer,
+                      warmup_steps=self.warmup_steps,
                       base_dir=self.base_dir)
 
         # we want to reinit our weights and biases to their defaults
         # after this we will copy the possible weights over
         self.sess.run([vae_tp1.init_op])  # ,vae_tp1.init_local_op])
 
-        # copy the encoder and decoder layers
-        # this helps convergence time
+        # copy the encoder and decoder layers [and optionally their
+        # Adam moments]; this helps convergence time
+        optimizers = (self.adam, vae_tp1.adam) if self.carry_optimizer \
+            else None
         copy_layer(self.sess, self.encoder_model, self.get_name(),
-                   encoder, vae_tp1.get_name())
+                   encoder, vae_tp1.get_name(),
+                   src_vars=self.vae_vars, dest_vars=vae_tp1.vae_vars,
+                   optimizers=optimizers)
         copy_layer(self.sess, self.decoder_model, self.get_name(),
-                   decoder, vae_tp1.get_name())
+                   decoder, vae_tp1.get_name(),
+                   src_vars=self.vae_vars, dest_vars=vae_tp1.vae_vars,
+                   optimizers=optimizers)
+        if self.carry_optimizer:
+            self._carry_beta_powers(vae_tp1)
+
+        # fill the student's replay buffer before its first step
+        vae_tp1.refresh_replay(block=True)
+
+        if self.release_ancestors:
+            self._freeze_as_teacher()
 
         return vae_tp1
 
+    @staticmethod
+    def _beta_powers(optimizer):
+        ''' Adam's [beta1_power, beta2_power], looked up by name '''
+        powers = []
+        for name in ["beta1_power", "beta2_power"]:
+            found = [v for v in optimizer.variables()
+                     if v.op.name.split("/")[-1] == name]
+            if len(found) != 1:
+                raise Exception("expected one %s in the optimizer variables, found %d"
+                                % (name, len(found)))
+
+            powers += found
+
+        return powers
+
+    def _carry_beta_powers(self, vae_tp1):
+        ''' Adam's bias correction of vae_tp1 continues from self '''
+        src = VAE._beta_powers(self.adam)
+        dest = VAE._beta_powers(vae_tp1.adam)
+        for d, value in zip(dest, self.sess.run(src)):
+            d.load(value, self.sess)
+
+    def _teacher_variables(self):
+        ''' what a student reads: encoder / generator weights & tau '''
+        prefixes = (self.get_name() + "/encoder", self.get_name() + "/generator")
+        slots = set(self.registry['slots'])
+        return [v for v in self.vae_vars
+                if v.name.startswith(prefixes) and v not in slots] \
+            + [self.iteration_gpu]
+
+    def _create_release_ops(self):
+        '''
+        Built once per model, only run on fork: 'student' releases all but
+        the teacher variables of self, 'teacher' the rest [once the student
+        of self is frozen in turn]. Each shrinks its variables to empty
+        tensors, which frees their buffers in the session.
+        '''
+        teacher = self._teacher_variables()
+        keep = set(teacher)
+        student = [v for v in self.vae_vars if v not in keep]
+        self.release_ops = {}
+        for key, variables in [('student', student), ('teacher', teacher)]:
+            op = tf.group(*[tf.assign(v, tf.zeros([0], dtype=v.dtype.base_dtype),
+                                      validate_shape=False)
+                            for v in variables])
+            self.release_ops[key] = (op, len(variables))
+
+    def _freeze_as_teacher(self):
+        '''
+        Once forked, only the encoder / generator of self are still read
+        [by the student]. Builds an inference-only reconstruction path for
+        self, releases the rest of self [optimizer slots, etc.] and all of
+        the previous teacher, closes their writers and drops the chain.
+        '''
+        if self.replay_thread is not None:
+            self.replay_thread.join()  # it reads the previous teacher
+
+        z, _, _, _, _, _ = self.encoder(self.x, reuse=True)
+        self.frozen_z = z
+        self.frozen_x_reconstr = self.generator(z, reuse=True).mean()
+
+        released = [self.release_ops['student']]
+        if self.vae_tm1 is not None:
+            released.append(self.vae_tm1.release_ops['teacher'])
+            self.vae_tm1.train_summary_writer.close()
+            self.vae_tm1.test_summary_writer.close()
+            self.vae_tm1 = None
+
+        self.sess.run([op for op, _ in released])
+        self.is_frozen = True
+        print 'froze %s, released %d variables' \
+            % (self.get_name(), sum(count for _, count in released))
+
+    def _input_feed(self, X):
+        ''' feeds X [and unrotated angles] in place of the graph input '''
+        feed_dict = {self.x_input: X}
+        if self.augment is not None:
+            feed_dict.update(self.augment.feed(np.zeros(len(X), np.float32)))
+
+        return feed_dict
+
     def transform(self, X):
         """Transform data by mapping it into the latent space."""
         # Note: This maps to mean of distribution, we could alternatively
         # sample from Gaussian distribution
-        return self.sess.run(self.z, feed_dict={self.x: X,
-                                                self.tau: self.tau_host,
-                                                self.is_training: False})
+        feed_dict = self._input_feed(X)
+        feed_dict[self.is_training] = False
+        return self.sess.run(self.frozen_z if self.is_frozen else self.z,
+                             feed_dict=feed_dict)
 
     def generate(self, z=None):
         """ Generate data by sampling from latent space.
@@ -874,12 +1210,18 @@ class VAE(object):
         # sample from Gaussian distribution
         return self.sess.run(self.p_x_given_z.mean(),
                              feed_dict={self.z: z,
-                                        self.tau: self.tau_host,
                                         self.is_training: False})
 
     def reconstruct(self, X, return_losses=False):
         """ Use VAE to reconstruct given data. """
-        if return_losses:
+        if self.is_frozen:
+            # a frozen teacher only keeps its inference path
+            if return_losses:
+                raise Exception("%s is frozen, losses are unavailable"
+                                % self.get_name())
+
+            ops = self.frozen_x_reconstr
+        elif return_losses:
             ops = [self.p_x_given_z.mean(),
                    self.reconstr_loss, self.reconstr_loss_mean,
                    self.latent_kl, self.latent_loss_mean,
@@ -887,19 +1229,23 @@ class VAE(object):
         else:
             ops = self.p_x_given_z.mean()
 
-        return self.sess.run(ops,
-                             feed_dict={self.x: X,
-                                        self.tau: self.tau_host,
-                                        self.is_training: False})
+        feed_dict = self._input_feed(X)
+        feed_dict[self.is_training] = False
+        return self.sess.run(ops, feed_dict=feed_dict)
 
     def test(self, source, batch_size, iteration_save_imgs=10):
         n_samples = source.num_examples
         avg_cost = avg_elbo = avg_recon = avg_latent = 0.
         total_batch = int(n_samples / batch_size)
 
+        # with an input queue the batches come from its test stream
+        if self.input_queue is not None:
+            self.input_queue.use("test")
+
         # Loop over all batches
         for i in range(total_batch):
-            batch_xs, _ = source.next_batch(batch_size)
+            batch_xs = source.next_batch(batch_size)[0] \
+                if self.input_queue is None else None
 
             # only save imgs if we are on the Nth test iteration
             if self.test_epoch % iteration_save_imgs == 0:
@@ -919,6 +1265,9 @@ class VAE(object):
             avg_recon += recon_cost / n_samples * batch_size
             avg_latent += latent_cost / n_samples * batch_size
 
+        if self.input_queue is not None:
+            self.input_queue.use("train")
+
         # Display logs at the end of testing
         self.test_epoch += 1
         print "[Test]", \
@@ -934,7 +1283,8 @@ class VAE(object):
             total_batch = int(n_samples / batch_size)
             # Loop over all batches
             for i in range(total_batch):
-                batch_xs, _ = source.train.next_batch(batch_size)
+                batch_xs = source.train.next_batch(batch_size)[0] \
+                    if self.input_queue is None else None
 
                 # Fit training using batch data
                 cost, elbo, recon_cost, latent_cost\
@@ -954,3 +1304,151 @@ class VAE(object):
                     "avg elbo = ", "{:.4f} | ".format(avg_elbo), \
                     "avg latent = ", "{:.4f} | ".format(avg_latent), \
                     "avg recon = ", "{:.4f}".format(avg_recon)
+
+
+class FixedCapacityVAE(VAE):
+    """ Lifelong VAE that is built once with max_discrete categories.
+
+    Only the first discrete_size categories are active [masked logits].
+    The teacher is a frozen weight snapshot living in the same graph, and
+    it replays the last num_replay rows of every batch from its active
+    categories [the teacher only runs on those rows].
+    fork() is therefore a constant time snapshot + mask update
+    that adds no ops to the graph; it returns self.
+    """
+    def __init__(self, sess, x, input_size, batch_size, latent_size,
+                 encoder, decoder, is_training, discrete_size,
+                 max_discrete=32, **kwargs):
+        self.num_active = discrete_size
+        VAE.__init__(self, sess, x, input_size, batch_size, latent_size,
+                     encoder, decoder, is_training, max_discrete, **kwargs)
+        self._create_fork_op()
+
+    def _create_variables(self, x_placeholder):
+        VAE._create_variables(self, x_placeholder)
+        with tf.variable_scope(self.get_name() + "/capacity"):
+            active = np.arange(self.num_discrete) < self.num_active
+            self.discrete_mask = tf.Variable(active.astype(np.float32),
+                                             trainable=False,
+                                             name="discrete_mask")
+            self.teacher_mask = tf.Variable(tf.zeros([self.num_discrete]),
+                                            trainable=False,
+                                            name="teacher_mask")
+            self.num_replay = tf.Variable(0, trainable=False,
+                                          name="num_replay")
+
+    def _create_fork_op(self):
+        # teacher/{encoder, generator} <- {encoder, generator}
+        name = self.get_name()
+        student = dict((v.name, v) for v in self.vae_vars)
+        teacher = [v for v in self.vae_vars
+                   if v.name.startswith(name + "/teacher/")]
+        snapshot = [t.assign(student[t.name.replace("/teacher/", "/", 1)])
+                    for t in teacher]
+        snapshot.append(self.teacher_mask.assign(self.discrete_mask))
+        snapshot.append(self.iteration_start.assign(self.iteration_gpu))
+
+        self.num_active_placeholder = tf.placeholder(tf.int32, shape=[])
+        self.num_replay_placeholder = tf.placeholder(tf.int32, shape=[])
+        with tf.control_dependencies(snapshot):
+            mask = tf.sequence_mask(self.num_active_placeholder,
+                                    self.num_discrete, dtype=tf.float32)
+            self.fork_op = tf.group(self.discrete_mask.assign(mask),
+                                    self.num_replay.assign(self.num_replay_placeholder))
+
+    def _masked_encoder(self, X, mask, scope, rnd_sample=None, hard=False,
+                        reuse=False):
+        with tf.variable_scope(self.get_name() + "/" + scope, reuse=reuse):
+            encoded = forward(X, self.encoder_model)
+            num_normal = shp(encoded)[1] - self.num_discrete
+            logits_gumbel = encoded[:, num_normal:] + (mask - 1.0) * 1e9
+            encoded = tf.concat([encoded[:, 0:num_normal], logits_gumbel],
+                                axis=1)
+            z, z_n, z_discrete, q_z, kl_n, kl_discrete \
+                = VAE.reparameterize(encoded, self.num_discrete, self.tau,
+                                     hard=hard, rnd_sample=rnd_sample)
+
+            # the prior is uniform over the active categories only
+            num_active = tf.reduce_sum(mask)
+            kl_discrete += tf.log(num_active / float(self.num_discrete))
+            return [z, z_n, z_discrete, q_z, kl_n, kl_discrete]
+
+    def encoder(self, X, rnd_sample=None, reuse=False, hard=False):
+        return self._masked_encoder(X, self.discrete_mask, "encoder",
+                                    rnd_sample=rnd_sample, hard=hard,
+                                    reuse=reuse)
+
+    def _pad_current(self, t):
+        ''' [batch_size - num_replay zero rows ; t], t being replayed rows '''
+        pad = tf.zeros(tf.concat([[self.batch_size - self.num_replay],
+                                  tf.shape(t)[1:]], axis=0), dtype=t.dtype)
+        padded = tf.concat([pad, t], axis=0)
+        padded.set_shape([self.batch_size] + shp(t)[1:])
+        return padded
+
+    def _generate_vae_tm1_data(self):
+        # the last num_replay rows are generated by the teacher snapshot;
+        # it only runs on those rows [none before the first fork]
+        self.is_replay = tf.range(self.batch_size) \
+            >= self.batch_size - self.num_replay
+        teacher_logits = tf.log(self.teacher_mask + 1e-20)
+        teacher_logits = tf.tile(tf.expand_dims(teacher_logits, 0),
+                                 tf.stack([self.num_replay, 1]))
+        z_discrete = tf.one_hot(tf.squeeze(tf.multinomial(teacher_logits, 1), 1),
+                                self.num_discrete)
+        z_normal = tf.random_normal(tf.stack([self.num_replay,
+                                              self.latent_size]))
+        z = tf.concat([z_normal, z_discrete], axis=1)
+        xhat = self.generator(z, scope="teacher/generator").mean()
+
+        self.z_discrete_tm1 = self._pad_current(z_discrete)
+        self.z_tm1 = self._pad_current(z)
+        self.xhat_tm1 = self._pad_current(xhat)
+
+    def _augment_data(self):
+        return tf.where(self.is_replay, self.xhat_tm1, self.x)
+
+    def _replayed(self, t):
+        return t[self.batch_size - self.num_replay:]
+
+    def _create_constraints(self):
+        # reverse KL between the teacher and student posteriors,
+        # only over [and only encoding] the replayed rows
+        _, _, _, q_z_t, _, _ \
+            = self._masked_encoder(self._replayed(self.x_augmented),
+                                   self.teacher_mask, "teacher/encoder",
+                                   rnd_sample=self._replayed(self.rnd_sample))
+        self.q_z_s_given_x_t = self._replayed(self.z_pre_gumbel)
+        self.q_z_t_given_x_t = q_z_t
+        kl = self.kl_categorical(q=q_z_t, p=self.q_z_s_given_x_t)
+        self.kl_consistency = self._pad_current(kl)
+
+    def _trainable_variables(self):
+        return [v for v in VAE._trainable_variables(self)
+                if "/teacher/" not in v.name]
+
+    def fork(self, num_new_class=1):
+        '''
+        Snapshot the student into the teacher, activate num_new_class
+        more categories and rebalance the replay rows [same split as VAE]
+        '''
+        if self.num_active + num_new_class > self.num_discrete:
+            raise Exception("discrete capacity of %d exhausted"
+                            % self.num_discrete)
+
+        self.num_active += num_new_class
+        self.total_true_models += num_new_class
+        self.submodel += 1
+        num_current_data = self._num_current_rows(self.batch_size)
+        self.sess.run(self.fork_op,
+                      feed_dict={self.num_active_placeholder: self.num_active,
+                                 self.num_replay_placeholder:
+                                 self.batch_size - num_current_data})
+        print 'forked [%d]: %d / %d active categories, %d replayed rows' \
+            % (self.submodel, self.num_active, self.num_discrete,
+               self.batch_size - num_current_data)
+        return self
+
+    def restore(self):
+        VAE.restore(self)
+        self.num_active = int(np.sum(self.sess.run(self.discrete_mask)))
@@ -1,13 +1,12 @@
 import os
-import h5py
 import numpy as np
 
-from copy import deepcopy
 from tensorflow.examples.tutorials.mnist import input_data
+from tensorflow.python.framework import dtypes
 from itertools import compress
-from utils import zip_filter_unzip
-from scipy.misc import imrotate as rotate
-from scipy.misc import imresize as imresize
+from data_store import DataSet, Datasets, load_or_build_store, filter_splits, \
+    resize_split, parallel_resize, rotate_split, rotate_batch, \
+    class_pipeline
 
 # An object that filters MNIST to a single number
 class MNIST_Number(object):
@@ -23,20 +22,9 @@ class MNIST_Number(object):
         else:
             self.blacklist = [1]  # the 'other' class
 
-        # filter out all other numbers
-        self.mnist = MNIST_Number.filter_numbers(mnist, self.blacklist)
-
-        # return images in [batch, row, col]
-        if not is_flat:
-            self.mnist = MNIST_Number._unflatten_mnist(self.mnist)
-
-        # resizes images if resize_dims tuple is provided
-        if resize_dims is not None:
-            self.mnist = MNIST_Number.resize_mnist(self.mnist, resize_dims)
-
-        # tile images as [img, img, img]
-        if convert_to_rgb:
-            self.mnist = MNIST_Number.bw_to_rgb_mnist(self.mnist)
+        # filter out all other numbers, then [unflatten, resize, rgb]
+        self.mnist = class_pipeline(self.blacklist, is_flat, resize_dims,
+                                    convert_to_rgb).apply_splits(mnist)
 
     @staticmethod
     def _unflatten_mnist(mnist):
@@ -47,103 +35,46 @@ class MNIST_Number(object):
 
     @staticmethod
     def resize_mnist(mnist, new_dims):
-        mnist.train._images = MNIST_Number.resize_images(mnist.train._images, new_dims)
-        mnist.validation._images = MNIST_Number.resize_images(mnist.validation._images, new_dims)
-        mnist.test._images = MNIST_Number.resize_images(mnist.test._images, new_dims)
+        # resized once per split and cached, class views stay views
+        resize_split(mnist.train, new_dims)
+        resize_split(mnist.validation, new_dims)
+        resize_split(mnist.test, new_dims)
         return mnist
 
     @staticmethod
     def bw_to_rgb_mnist(mnist):
-        mnist.train._images = MNIST_Number.bw_to_rgb(mnist.train._images)
-        mnist.validation._images = MNIST_Number.bw_to_rgb(mnist.validation._images)
-        mnist.test._images = MNIST_Number.bw_to_rgb(mnist.test._images)
+        # pixels stay single channel uint8, rgb is broadcast per batch
+        mnist.train.to_rgb()
+        mnist.validation.to_rgb()
+        mnist.test.to_rgb()
         return mnist
 
-
     @staticmethod
     def resize_images(imgs, new_dims, flatten=False):
         flattened_dims = [-1, np.prod(new_dims)] if flatten else [-1] + new_dims
-        return np.vstack([imresize(img.reshape(28, 28),
-                                   new_dims).reshape(flattened_dims)
-                          for img in imgs]) / 255.
+        return parallel_resize(imgs.reshape([-1, 28, 28]),
+                               new_dims).reshape(flattened_dims)
 
     @staticmethod
     def bw_to_rgb(imgs):
-        return np.vstack([np.tile(img.reshape(img.shape[0], imgs.shape[1], 1), 3)
-                          .reshape(-1, img.shape[0], img.shape[1], 3)
-                          for img in imgs])
+        return np.repeat(imgs[..., np.newaxis], 3, axis=-1)
 
     @staticmethod
     def _rotate_batch(batch, angle):
-        return np.vstack([rotate(x_i.reshape(28, 28), angle).reshape([-1, 28*28])
-                          for x_i in batch]) / 255.
-
-    @staticmethod
-    def _check_and_load_angle(angle, number, base_path='MNIST_data'):
-        ''' Returns None if the file doesn't exists'''
-        filename = os.path.join(base_path, "mnist_num%d_angle%d.hdf5"
-                                % (number, angle))
-        if os.path.exists(filename):
-            f = h5py.File(filename, "r")
-            return f['train'][()], f['validation'][()], f['test'][()]
-            # return f['train'], f['validation'], f['test']
-
-        return None
-
-    @staticmethod
-    def _check_and_write_angle(angle, number, mnist, base_path='MNIST_data'):
-        ''' serializes the rotated number to disk as a hdf5 file'''
-        filename = os.path.join(base_path, "mnist_num%d_angle%d.hdf5"
-                                % (number, angle))
-        if not os.path.exists(filename):
-            f = h5py.File(filename, "w")
-            f['train'] = mnist.train._images
-            f['validation'] = mnist.validation._images
-            f['test'] = mnist.test._images
-
-            print 'serialized %s to disk...' % filename
+        return rotate_batch(batch.reshape([-1, 28, 28]), angle).reshape(batch.shape)
 
     @staticmethod
     def rotate_all_sets(mnist, number, angle):
-        hpf5_load = MNIST_Number._check_and_load_angle(angle, number)
-        if hpf5_load is not None:
-            train_imgs = np.asarray(hpf5_load[0], np.float32)
-            validation_imgs = np.asarray(hpf5_load[1], np.float32)
-            test_imgs = np.asarray(hpf5_load[2], np.float32)
-        else:
-            train_imgs = MNIST_Number._rotate_batch(mnist.train._images, angle)
-            validation_imgs = MNIST_Number._rotate_batch(mnist.validation._images, angle)
-            test_imgs = MNIST_Number._rotate_batch(mnist.test._images, angle)
-
-        mnist.train._images = train_imgs
-        mnist.validation._images = validation_imgs
-        mnist.test._images = test_imgs
-
-        MNIST_Number._check_and_write_angle(angle, number, mnist)
+        # all angles live in one rotation store, each set is a lazy slice
+        rotate_split(mnist.train, angle)
+        rotate_split(mnist.validation, angle)
+        rotate_split(mnist.test, angle)
         return mnist
 
     @staticmethod
     def filter_numbers(mnist, blacklist):
-        digits = deepcopy(mnist)
-        digits.train._images, digits.train._labels = zip_filter_unzip(digits.train._images
-                                                                      , digits.train._labels
-                                                                      , blacklist)
-        digits.train._images = np.array(digits.train._images)
-        digits.train._labels = np.array(digits.train._labels)
-        digits.train._num_examples = len(digits.train.images)
-        digits.validation._images, digits.validation._labels = zip_filter_unzip(digits.validation._images
-                                                                                , digits.validation._labels
-                                                                                , blacklist)
-        digits.validation._num_examples = len(digits.validation.images)
-        digits.validation._images = np.array(digits.validation._images)
-        digits.validation._labels = np.array(digits.validation._labels)
-        digits.test._images, digits.test._labels = zip_filter_unzip(digits.test._images
-                                                                    , digits.test._labels
-                                                                    , blacklist)
-        digits.test._images = np.array(digits.test._images)
-        digits.test._labels = np.array(digits.test._labels)
-        digits.test._num_examples = len(digits.test.images)
-        return digits
+        ''' index views over the shared splits, nothing is copied '''
+        return filter_splits(mnist, blacklist)
 
     # if one vs. all then 0 = true class, 1 = other
     # otherwise we just use lbl = lbl,  10 = other
@@ -172,30 +103,17 @@ class MNIST_Number(object):
         return np.array(images), np.array(labels)
 
     def get_test_batch_iter(self, batch_size):
-        images = []; labels = []; count = 0
-        while(count < batch_size):
-            max_batch = self.mnist.test._num_examples
-            im, lbl = self._get_test_batch_iter(max_batch)
-            tar = 0 if self.is_one_vs_all else self.number
-            if tar in lbl:
-                im, lbl = zip_filter_unzip(im, lbl, self.blacklist)
-                count += len(im)
-                #  im = np.asarray(im); lbl = np.asarray(lbl); count += len(lbl)
-                images.append(im); labels.append(lbl)
-
-        return np.vstack(images)[0:batch_size], np.hstack(labels)[0:batch_size]
+        # only the test examples of our number, labeled as in _augment
+        images, labels = self.mnist.test.class_sampler([self.number]).next_batch(batch_size)
+        if self.is_one_vs_all:
+            labels = np.zeros_like(labels)  # 0 = true class
 
-    def get_batch_iter(self, batch_size):
-        images = []; labels = []; count = 0
-        while(count < batch_size):
-            im, lbl = self.get_train_batch_iter(batch_size)
-            tar = 0 if self.is_one_vs_all else self.number
-            if tar in lbl:
-                # im, lbl = zip_filter_unzip(im, lbl, self.blacklist)
-                im = np.asarray(im); lbl = np.asarray(lbl); count += len(lbl)
-                images.append(im); labels.append(lbl)
+        return images, labels
 
-        return np.vstack(images)[0:batch_size], np.hstack(labels)[0:batch_size]
+    def get_batch_iter(self, batch_size):
+        # one-vs-all keeps every other number [except the blacklisted 1]
+        numbers = None if self.is_one_vs_all else [self.number]
+        return self.mnist.train.class_sampler(numbers).next_batch(batch_size)
 
 
 class AllMnist():
@@ -203,23 +121,12 @@ class AllMnist():
                  is_flat=True,
                  resize_dims=None,
                  convert_to_rgb=False):
-        self.mnist = input_data.read_data_sets('MNIST_data', one_hot=one_hot)
+        self.mnist = class_pipeline([], is_flat, resize_dims, convert_to_rgb)\
+                     .apply_splits(load_mnist(one_hot=one_hot))
         self.one_hot = one_hot
         self.number = 99997 # XXX
         self.num_examples = self.mnist.test._num_examples
 
-        # return images in [batch, row, col]
-        if not is_flat:
-            self.mnist = MNIST_Number._unflatten_mnist(self.mnist)
-
-        # resizes images if resize_dims tuple is provided
-        if resize_dims is not None:
-            self.mnist = MNIST_Number.resize_mnist(self.mnist, resize_dims)
-
-        # tile images as [img, img, img]
-        if convert_to_rgb:
-            self.mnist = MNIST_Number.bw_to_rgb_mnist(self.mnist)
-
     def get_train_batch_iter(self, batch_size):
         images, labels = self.mnist.train.next_batch(batch_size)
         #images, labels = self._augment(images, labels)
@@ -242,8 +149,31 @@ class AllMnist():
         return self.get_train_batch_iter(batch_size)
 
 
-# Read mnist only once [~ 230Mb]
-full_mnist = input_data.read_data_sets('MNIST_data', one_hot=False)
+def _build_mnist_store():
+    ''' parses the gzipped mnist files as raw uint8 [only run once] '''
+    mnist = input_data.read_data_sets('MNIST_data', one_hot=False,
+                                      dtype=dtypes.uint8)
+    return {'train': (mnist.train.images, mnist.train.labels),
+            'validation': (mnist.validation.images, mnist.validation.labels),
+            'test': (mnist.test.images, mnist.test.labels)}
+
+
+def load_mnist(one_hot=False):
+    ''' opens the memory-mapped mnist store, building it on first use '''
+    splits = load_or_build_store('mnist', Datasets._fields, _build_mnist_store)
+    datasets = []
+    for split in Datasets._fields:
+        images, labels = splits[split]
+        if one_hot:
+            labels = np.eye(10, dtype=np.float32)[labels]
+
+        datasets.append(DataSet(images, labels, store_key=('mnist', split)))
+
+    return Datasets(*datasets)
+
+
+# Open mnist only once [memory-mapped uint8, shared across processes]
+full_mnist = load_mnist(one_hot=False)
 # full_mnist.train._images /= 255.
 # full_mnist.validation._images /= 255.
 # full_mnist.test._images /= 255.
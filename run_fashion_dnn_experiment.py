@@ -1,6 +1,4 @@
 import os
-import sys
-sys.setrecursionlimit(200)
 import matplotlib as mpl
 mpl.use('Agg')
 import matplotlib.pyplot as plt
@@ -10,6 +8,8 @@ import numpy as np
 
 import tensorflow.contrib.distributions as distributions
 from fashion_number import Fashion_Class, Fashion, fashion
+from data_store import ROTATION_ANGLES, generate_from_index, \
+    prefetch_train_data
 from lifelong_vae import VAE
 from vanilla_vae import VanillaVAE
 from encoders import DenseEncoder, CNNEncoder
@@ -144,6 +144,7 @@ def build_Nd_vae(sess, source, input_shape, latent_size,
         mean_recon = []
         mean_latent = []
 
+        prefetcher = None
         try:
             if not FLAGS.sequential:
                 vae.train(source[0], batch_size, display_step=1,
@@ -158,6 +159,9 @@ def build_Nd_vae(sess, source, input_shape, latent_size,
                 current_model = 0
                 total_iter = 0
                 all_models = [(current_model, source[current_model].number)]
+                prefetcher = prefetch_train_data(source, create_indexes,
+                                                 batch_size, batch_size,
+                                                 current_model)
 
                 while True:
                     # fork if we get a new model
@@ -167,12 +171,8 @@ def build_Nd_vae(sess, source, input_shape, latent_size,
                     if total_iter % 200 == 0:
                         vae.test(TEST_SET, batch_size)
 
-                    # data iterator
-                    inputs, outputs, indexes, current_model \
-                        = generate_train_data(source,
-                                              batch_size,
-                                              batch_size,
-                                              current_model)
+                    # data iterator [assembled ahead by the prefetch thread]
+                    inputs, outputs, indexes, current_model = prefetcher.get()
 
                     # Distribution shift Swapping logic
                     if prev_model != current_model:
@@ -226,6 +226,9 @@ def build_Nd_vae(sess, source, input_shape, latent_size,
 
         except KeyboardInterrupt:
             print "caught keyboard exception..."
+        finally:
+            if prefetcher is not None:
+                prefetcher.close()
 
         vae.save()
         if FLAGS.sequential:
@@ -485,22 +488,11 @@ def create_indexes(num_train, num_models, current_model):
     return current_model, [current_model] * num_train
 
 
-def _generate_from_index(generators, gen_indexes):
-    try:
-        full_data = [generators[t].get_batch_iter(1) for t in gen_indexes]
-        inputs = np.vstack([t[0] for t in full_data])
-        outputs = np.vstack([t[1] for t in full_data])
-        return inputs, outputs, gen_indexes
-    except Exception as e:
-        print 'caught exception in gen_from_index: ', e
-        print 'len generators = %d | t = %d' % (len(generators), t)
-
-
 def generate_train_data(generators, num_train, batch_size, current_model):
     current_model, indexes = create_indexes(num_train, len(generators), current_model)
     num_batches = int(np.floor(len(indexes) / batch_size))
     indexes = indexes[0:num_batches * batch_size]  # dump extra data
-    inputs, outputs, _ = _generate_from_index(generators, indexes)
+    inputs, outputs, _ = generate_from_index(generators, indexes)
     return inputs, outputs, indexes, current_model
 
 
@@ -508,7 +500,7 @@ def generate_test_data(generators, num_train, batch_size):
     indexes = list(np.arange(len(generators))) * num_train
     num_batches = int(np.floor(len(indexes) / batch_size))
     indexes = indexes[0:num_batches * batch_size]  # dump extra data
-    return _generate_from_index(generators, indexes)
+    return generate_from_index(generators, indexes)
 
 
 def evaluate_running_hist(vae):
@@ -525,7 +517,7 @@ def rotate_fashion(generators):
         adds (10x + 1) the number of distributions'''
     rotated = []
     for n in xrange(len(generators)):
-        for t in [30, 45, 70, 90, 130, 165, 200, 250, 295, 335]:
+        for t in ROTATION_ANGLES:
             number = Fashion_Class(n, fashion)
             number.mnist = Fashion_Class.rotate_all_sets(number.classes,  n, t)
             rotated.append(number)
@@ -1,6 +1,4 @@
 import os
-import sys
-sys.setrecursionlimit(200)
 import matplotlib as mpl
 mpl.use('Agg')
 import matplotlib.pyplot as plt
@@ -8,9 +6,10 @@ import tensorflow as tf
 import numpy as np
 
 import tensorflow.contrib.distributions as distributions
-from tensorflow.examples.tutorials.mnist import input_data
 from cifar_class import CIFAR_Class, CIFAR10, cifar10
-from mnist_number import MNIST_Number, full_mnist
+from mnist_number import MNIST_Number, full_mnist, load_mnist
+from data_store import Pipeline, Resize, ToRGB, generate_from_index, \
+    prefetch_train_data
 from lifelong_vae import VAE
 from vanilla_vae import VanillaVAE
 from encoders import DenseEncoder, CNNEncoder
@@ -41,10 +40,8 @@ FLAGS = flags.FLAGS
 GLOBAL_ITER = 0  # keeps track of the iteration ACROSS models
 TRAIN_ITER  = 0  # the iteration of the current model
 TEST_SET_CIFAR = cifar10.test
-TEST_SET_MNIST = input_data.read_data_sets('MNIST_data', one_hot=True).test
-TEST_SET_MNIST._images = TEST_SET_MNIST._images.reshape([-1, 28, 28])
-TEST_SET_MNIST._images = MNIST_Number.resize_images(TEST_SET_MNIST._images, [32, 32])
-TEST_SET_MNIST._images = MNIST_Number.bw_to_rgb(TEST_SET_MNIST._images)
+TEST_SET_MNIST = Pipeline([Resize([32, 32]), ToRGB()])\
+                 .apply(load_mnist(one_hot=True).test)
 
 def _build_latest_base_dir(base_name):
     current_index = _find_latest_experiment_number(base_name) + 1
@@ -138,6 +135,7 @@ def build_Nd_vae(sess, source, input_shape, latent_size,
         mean_recon_cifar = []
         mean_latent_cifar = []
 
+        prefetcher = None
         try:
             if not FLAGS.sequential:
                 vae.train(source[0], batch_size, display_step=1,
@@ -166,6 +164,9 @@ def build_Nd_vae(sess, source, input_shape, latent_size,
                 current_model = 0
                 total_iter = 0
                 all_models = [(current_model, source[current_model].number)]
+                prefetcher = prefetch_train_data(source, create_indexes,
+                                                 batch_size, batch_size,
+                                                 current_model)
 
                 while True:
                     # fork if we get a new model
@@ -175,12 +176,8 @@ def build_Nd_vae(sess, source, input_shape, latent_size,
                     if total_iter % 200 == 0:
                         vae.test(TEST_SET, batch_size)
 
-                    # data iterator
-                    inputs, outputs, indexes, current_model \
-                        = generate_train_data(source,
-                                              batch_size,
-                                              batch_size,
-                                              current_model)
+                    # data iterator [assembled ahead by the prefetch thread]
+                    inputs, outputs, indexes, current_model = prefetcher.get()
 
                     # Distribution shift Swapping logic
                     if prev_model != current_model:
@@ -246,6 +243,9 @@ def build_Nd_vae(sess, source, input_shape, latent_size,
 
         except KeyboardInterrupt:
             print "caught keyboard exception..."
+        finally:
+            if prefetcher is not None:
+                prefetcher.close()
 
         vae.save()
         if FLAGS.sequential:
@@ -505,22 +505,11 @@ def create_indexes(num_train, num_models, current_model):
     return current_model, [current_model] * num_train
 
 
-def _generate_from_index(generators, gen_indexes):
-    try:
-        full_data = [generators[t].get_batch_iter(1) for t in gen_indexes]
-        inputs = np.vstack([t[0] for t in full_data])
-        outputs = np.vstack([t[1] for t in full_data])
-        return inputs, outputs, gen_indexes
-    except Exception as e:
-        print 'caught exception in gen_from_index: ', e
-        print 'len generators = %d | t = %d' % (len(generators), t)
-
-
 def generate_train_data(generators, num_train, batch_size, current_model):
     current_model, indexes = create_indexes(num_train, len(generators), current_model)
     num_batches = int(np.floor(len(indexes) / batch_size))
     indexes = indexes[0:num_batches * batch_size]  # dump extra data
-    inputs, outputs, _ = _generate_from_index(generators, indexes)
+    inputs, outputs, _ = generate_from_index(generators, indexes)
     return inputs, outputs, indexes, current_model
 
 
@@ -528,7 +517,7 @@ def generate_test_data(generators, num_train, batch_size):
     indexes = list(np.arange(len(generators))) * num_train
     num_batches = int(np.floor(len(indexes) / batch_size))
     indexes = indexes[0:num_batches * batch_size]  # dump extra data
-    return _generate_from_index(generators, indexes)
+    return generate_from_index(generators, indexes)
 
 
 def evaluate_running_hist(vae):
@@ -1,6 +1,4 @@
 import os
-import sys
-sys.setrecursionlimit(200)
 import matplotlib as mpl
 mpl.use('Agg')
 import matplotlib.pyplot as plt
@@ -8,10 +6,11 @@ import tensorflow as tf
 import numpy as np
 
 import tensorflow.contrib.distributions as distributions
-from tensorflow.examples.tutorials.mnist import input_data
 
 from svhn_class import svhn, SVHN_Class, SVHN
-from mnist_number import MNIST_Number, full_mnist, AllMnist
+from mnist_number import MNIST_Number, full_mnist, AllMnist, load_mnist
+from data_store import Pipeline, Resize, ToRGB, generate_from_index, \
+    prefetch_train_data
 from lifelong_vae import VAE
 from vanilla_vae import VanillaVAE
 from encoders import DenseEncoder, CNNEncoder
@@ -36,16 +35,15 @@ flags.DEFINE_float("mutual_info_reg", 0.0, "coefficient of mutual information [0
 flags.DEFINE_string("base_dir", ".", "base dir to store experiments")
 flags.DEFINE_bool("rotate_svhn", 0, "if true adds 10x+1 rotated versions of SVHN [for seq only]")
 flags.DEFINE_bool("compress_rotations", 0, "if true doesn't add a new class for rotations")
+flags.DEFINE_bool("svhn_extra", 0, "if true trains on the train + extra [531k] SVHN splits")
 FLAGS = flags.FLAGS
 
 # Global variables
 GLOBAL_ITER = 0  # keeps track of the iteration ACROSS models
 TRAIN_ITER  = 0  # the iteration of the current model
 TEST_SET_SVHN = svhn.test
-TEST_SET_MNIST = input_data.read_data_sets('MNIST_data', one_hot=True).test
-TEST_SET_MNIST._images = TEST_SET_MNIST._images.reshape([-1, 28, 28])
-TEST_SET_MNIST._images = MNIST_Number.resize_images(TEST_SET_MNIST._images, [32, 32])
-TEST_SET_MNIST._images = MNIST_Number.bw_to_rgb(TEST_SET_MNIST._images)
+TEST_SET_MNIST = Pipeline([Resize([32, 32]), ToRGB()])\
+                 .apply(load_mnist(one_hot=True).test)
 
 def _build_latest_base_dir(base_name):
     current_index = _find_latest_experiment_number(base_name) + 1
@@ -139,6 +137,7 @@ def build_Nd_vae(sess, source, input_shape, latent_size,
         mean_recon_svhn = []
         mean_latent_svhn = []
 
+        prefetcher = None
         try:
             if not FLAGS.sequential:
                 vae.train(source[0], batch_size, display_step=1,
@@ -167,6 +166,9 @@ def build_Nd_vae(sess, source, input_shape, latent_size,
                 current_model = 0
                 total_iter = 0
                 all_models = [(current_model, source[current_model].number)]
+                prefetcher = prefetch_train_data(source, create_indexes,
+                                                 batch_size, batch_size,
+                                                 current_model)
 
                 while True:
                     # fork if we get a new model
@@ -177,11 +179,8 @@ def build_Nd_vae(sess, source, input_shape, latent_size,
                         vae.test(TEST_SET_SVHN, batch_size)
                         vae.test(TEST_SET_MNIST, batch_size)
 
-                    inputs, outputs, indexes, current_model \
-                        = generate_train_data(source,
-                                              batch_size,
-                                              batch_size,
-                                              current_model)
+                    # data iterator [assembled ahead by the prefetch thread]
+                    inputs, outputs, indexes, current_model = prefetcher.get()
 
                     # Distribution shift Swapping logic
                     if prev_model != current_model:
@@ -249,6 +248,9 @@ def build_Nd_vae(sess, source, input_shape, latent_size,
 
         except KeyboardInterrupt:
             print "caught keyboard exception..."
+        finally:
+            if prefetcher is not None:
+                prefetcher.close()
 
         vae.save()
         if FLAGS.sequential:
@@ -507,22 +509,11 @@ def create_indexes(num_train, num_models, current_model):
     return current_model, [current_model] * num_train
 
 
-def _generate_from_index(generators, gen_indexes):
-    try:
-        full_data = [generators[t].get_batch_iter(1) for t in gen_indexes]
-        inputs = np.vstack([t[0] for t in full_data])
-        outputs = np.vstack([t[1] for t in full_data])
-        return inputs, outputs, gen_indexes
-    except Exception as e:
-        print 'caught exception in gen_from_index: ', e
-        print 'len generators = %d | t = %d' % (len(generators), t)
-
-
 def generate_train_data(generators, num_train, batch_size, current_model):
     current_model, indexes = create_indexes(num_train, len(generators), current_model)
     num_batches = int(np.floor(len(indexes) / batch_size))
     indexes = indexes[0:num_batches * batch_size]  # dump extra data
-    inputs, outputs, _ = _generate_from_index(generators, indexes)
+    inputs, outputs, _ = generate_from_index(generators, indexes)
     return inputs, outputs, indexes, current_model
 
 
@@ -530,7 +521,7 @@ def generate_test_data(generators, num_train, batch_size):
     indexes = list(np.arange(len(generators))) * num_train
     num_batches = int(np.floor(len(indexes) / batch_size))
     indexes = indexes[0:num_batches * batch_size]  # dump extra data
-    return _generate_from_index(generators, indexes)
+    return generate_from_index(generators, indexes)
 
 
 def evaluate_running_hist(vae):
@@ -563,9 +554,10 @@ def main():
                              is_flat=False,
                              resize_dims=[32, 32],
                              convert_to_rgb=True)
-        generators = [SVHN(one_hot=True), all_mnist]  # [SVHN_Class(0, svhn)]
+        generators = [SVHN(one_hot=True, extra=FLAGS.svhn_extra),
+                      all_mnist]  # [SVHN_Class(0, svhn)]
     else:
-        generators = [SVHN(one_hot=True)]
+        generators = [SVHN(one_hot=True, extra=FLAGS.svhn_extra)]
 
     print 'there are %d generators' % len(generators)
 
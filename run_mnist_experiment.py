@@ -1,6 +1,4 @@
 import os
-import sys
-sys.setrecursionlimit(200)
 import matplotlib as mpl
 mpl.use('Agg')
 import matplotlib.pyplot as plt
@@ -8,9 +6,10 @@ import tensorflow as tf
 import numpy as np
 
 import tensorflow.contrib.distributions as distributions
-from tensorflow.examples.tutorials.mnist import input_data
-from mnist_number import MNIST_Number, full_mnist
-from lifelong_vae import VAE
+from mnist_number import MNIST_Number, full_mnist, load_mnist
+from data_store import ROTATION_ANGLES, generate_from_index, \
+    prefetch_train_data
+from lifelong_vae import VAE, FixedCapacityVAE
 from vanilla_vae import VanillaVAE
 from encoders import DenseEncoder, CNNEncoder
 from decoders import CNNDecoder
@@ -34,12 +33,22 @@ flags.DEFINE_float("mutual_info_reg", 0.0, "coefficient of mutual information [0
 flags.DEFINE_string("base_dir", ".", "base dir to store experiments")
 flags.DEFINE_bool("rotate_mnist", 0, "if true adds 10x+1 rotated versions of MNIST [for seq only]")
 flags.DEFINE_bool("compress_rotations", 0, "if true doesn't add a new class for rotations")
+flags.DEFINE_bool("graph_augment", 0, "if true resizes / rotates / tiles to rgb on the graph instead of storing the variants")
+flags.DEFINE_bool("graph_input", 0, "if true batches are dequeued on the graph instead of fed per step [for seq only]")
+flags.DEFINE_integer("fixed_capacity", 0, "if > 0 builds one graph with this many discrete categories and forks in place [for seq only]")
+flags.DEFINE_bool("release_ancestors", 0, "if true a fork freezes the teacher and releases all older models [for seq only]")
+flags.DEFINE_integer("replay_size", 0, "if > 0 the teacher replays from a cached buffer of this many rows [for seq only]")
+flags.DEFINE_integer("replay_every", 500, "steps between background refreshes of the replay buffer")
+flags.DEFINE_float("current_fraction", 0.0, "if > 0 fixes the fraction of each batch that is current data; else 1/(num_models+1) [for seq only]")
+flags.DEFINE_bool("carry_optimizer", 0, "if true a fork copies the Adam moments & beta powers of the copied layers [for seq only]")
+flags.DEFINE_integer("warmup_steps", 0, "if > 0 linearly warms up the learning rate over this many steps after every fork [for seq only]")
+flags.DEFINE_integer("steps_per_call", 1, "optimizer steps per partial_fit_n call; distribution swaps are drawn per call [for seq only]")
 FLAGS = flags.FLAGS
 
 # Global variables
 GLOBAL_ITER = 0  # keeps track of the iteration ACROSS models
 TRAIN_ITER  = 0  # the iteration of the current model
-TEST_SET    = input_data.read_data_sets('MNIST_data', one_hot=True).test
+TEST_SET    = load_mnist(one_hot=True).test
 
 
 def _build_latest_base_dir(base_name):
@@ -76,13 +85,33 @@ def build_Nd_vae(sess, source, input_shape, latent_size,
 
     # our placeholders are generated externall
     is_training = tf.placeholder(tf.bool)
-    x = tf.placeholder(tf.float32, shape=[FLAGS.batch_size] + [input_shape],
-                       name="input_placeholder")
+    vae_kwargs = {}
+    angles = None
+    if FLAGS.graph_input and FLAGS.sequential:
+        # x [and the rotation angles] are dequeued from the train / test
+        # streams, see start_input_streams
+        input_queue = QueueInput(sess, [[FLAGS.batch_size, input_shape],
+                                        [FLAGS.batch_size]])
+        x, angles = input_queue.components
+        vae_kwargs['input_queue'] = input_queue
+    else:
+        x = tf.placeholder(tf.float32, shape=[FLAGS.batch_size] + [input_shape],
+                           name="input_placeholder")
+
+    # feed the canonical 28x28 data, VAE.x is the augmented batch
+    if FLAGS.graph_augment:
+        augment = GraphAugment(FLAGS.batch_size, [28, 28],
+                               resize_dims=[32, 32] if FLAGS.sequential else None,
+                               channels=3 if FLAGS.sequential else 1,
+                               rotate=FLAGS.rotate_mnist, angles=angles)
+        input_shape = augment.output_size
+        vae_kwargs.update({'augment': augment, 'img_shape': augment.img_shape})
 
     # build encoder and decoder models
     # note: these can be externally built
     #       as long as it works with forward()
-    latent_size = 2*FLAGS.latent_size + 1 if FLAGS.sequential \
+    num_discrete = FLAGS.fixed_capacity if FLAGS.fixed_capacity > 0 else 1
+    latent_size = 2*FLAGS.latent_size + num_discrete if FLAGS.sequential \
                   else 2*FLAGS.latent_size
     # encoder = DenseEncoder(sess, latent_size,
     #                        is_training,
@@ -112,6 +141,19 @@ def build_Nd_vae(sess, source, input_shape, latent_size,
 
     # build the vae object
     VAEObj = VAE if FLAGS.sequential else VanillaVAE
+    if FLAGS.sequential and FLAGS.fixed_capacity > 0:
+        VAEObj = FixedCapacityVAE
+        vae_kwargs['max_discrete'] = FLAGS.fixed_capacity
+    elif FLAGS.sequential:
+        vae_kwargs.update({'release_ancestors': FLAGS.release_ancestors,
+                           'replay_size': FLAGS.replay_size,
+                           'replay_every': FLAGS.replay_every,
+                           'carry_optimizer': FLAGS.carry_optimizer})
+    if FLAGS.sequential:
+        vae_kwargs['warmup_steps'] = FLAGS.warmup_steps
+    if FLAGS.sequential and FLAGS.current_fraction > 0:
+        vae_kwargs['current_fraction'] = lambda _: FLAGS.current_fraction
+
     vae = VAEObj(sess, x, input_size=input_shape,
                  batch_size=FLAGS.batch_size,
                  latent_size=FLAGS.latent_size,
@@ -122,7 +164,8 @@ def build_Nd_vae(sess, source, input_shape, latent_size,
                  submodel=latest_model[1],
                  vae_tm1=None, base_dir=base_name,
                  p_x_given_z_func=distributions.Bernoulli,
-                 mutual_info_reg=FLAGS.mutual_info_reg)
+                 mutual_info_reg=FLAGS.mutual_info_reg,
+                 **vae_kwargs)
 
     model_filename = "%s/models/%s" % (base_name, latest_model[0])
     is_forked = False
@@ -139,6 +182,7 @@ def build_Nd_vae(sess, source, input_shape, latent_size,
         mean_recon = []
         mean_latent = []
 
+        prefetcher = None
         try:
             if not FLAGS.sequential:
                 vae.train(source[0], batch_size, display_step=1,
@@ -153,6 +197,16 @@ def build_Nd_vae(sess, source, input_shape, latent_size,
                 current_model = 0
                 total_iter = 0
                 all_models = [(current_model, source[current_model].number)]
+                gen_angles = np.array([getattr(g, 'angle', 0) for g in source],
+                                      dtype=np.float32)
+                num_steps = FLAGS.steps_per_call
+                prefetcher = prefetch_train_data(source, create_indexes,
+                                                 batch_size * num_steps, batch_size,
+                                                 current_model)
+                pending_info = None  # first queued batch of the next call
+                if vae.input_queue is not None:
+                    start_input_streams(vae.input_queue, prefetcher,
+                                        gen_angles, batch_size)
 
                 while True:
                     # fork if we get a new model
@@ -162,12 +216,30 @@ def build_Nd_vae(sess, source, input_shape, latent_size,
                     if total_iter % 200 == 0:
                         vae.test(TEST_SET, batch_size)
 
-                    # data iterator
-                    inputs, outputs, indexes, current_model \
-                        = generate_train_data(source,
-                                              batch_size,
-                                              batch_size,
-                                              current_model)
+                    # data iterator [assembled ahead by the prefetch thread]
+                    call_steps = num_steps
+                    if vae.input_queue is not None:
+                        # the batches themselves are already on the graph;
+                        # a call stops before a distribution switch and the
+                        # switching batch starts the next call
+                        if pending_info is None:
+                            pending_info = vae.input_queue.next_info()
+
+                        current_model = pending_info[1]
+                        call_steps, pending_info = 1, None
+                        while call_steps < num_steps:
+                            info = vae.input_queue.next_info()
+                            if info[1] != current_model:
+                                pending_info = info
+                                break
+
+                            call_steps += 1
+
+                        x, x_angles = None, None
+                    else:
+                        # a prefetched call is drawn from a single model
+                        x, outputs, indexes, current_model = prefetcher.get()
+                        x_angles = gen_angles[indexes]
 
                     # Distribution shift Swapping logic
                     if prev_model != current_model:
@@ -210,18 +282,22 @@ def build_Nd_vae(sess, source, input_shape, latent_size,
                         all_models.append((current_model,
                                            source[current_model].number))
 
-                    for start, end in zip(range(0, len(inputs) + 1, batch_size),
-                                          range(batch_size, len(inputs) + 1, batch_size)):
-                        x = inputs[start:end]
-                        loss, elbo, rloss, lloss = vae.partial_fit(x, is_forked=is_forked)
-                        print 'loss[total_iter=%d][iter=%d][model=%d] = %f, elbo loss = %f, latent loss = %f, reconstr loss = %f' \
-                            % (total_iter, vae.iteration, current_model, loss, elbo, lloss,
-                               rloss if rloss is not None else 0.0)
+                    loss, elbo, rloss, lloss = vae.partial_fit_n(x, call_steps,
+                                                                 is_forked=is_forked,
+                                                                 angles=x_angles)
+                    print 'loss[total_iter=%d][iter=%d][model=%d] = %f, elbo loss = %f, latent loss = %f, reconstr loss = %f' \
+                        % (total_iter, vae.iteration, current_model, loss, elbo, lloss,
+                           rloss if rloss is not None else 0.0)
 
                     total_iter += 1
 
         except KeyboardInterrupt:
             print "caught keyboard exception..."
+        finally:
+            if FLAGS.sequential and vae.input_queue is not None:
+                vae.input_queue.close()
+            if prefetcher is not None:
+                prefetcher.close()
 
         vae.save()
         if FLAGS.sequential:
@@ -443,8 +519,7 @@ def plot_Nd_vae(sess, source, vae, batch_size):
         x_sample = source[0].test.next_batch(batch_size)[0]
         x_reconstruct = vae.reconstruct(x_sample)
     elif FLAGS.sequential:
-        x_sample = input_data.read_data_sets('MNIST_data', one_hot=True)\
-                             .test.next_batch(batch_size)[0]
+        x_sample = TEST_SET.next_batch(batch_size)[0]
         x_reconstruct = vae.reconstruct(x_sample)
         x_reconstruct_tm1 = []
         vae_tm1 = vae.vae_tm1
@@ -481,30 +556,40 @@ def create_indexes(num_train, num_models, current_model):
     return current_model, [current_model] * num_train
 
 
-def _generate_from_index(generators, gen_indexes):
-    try:
-        full_data = [generators[t].get_batch_iter(1) for t in gen_indexes]
-        inputs = np.vstack([t[0] for t in full_data])
-        outputs = np.vstack([t[1] for t in full_data])
-        return inputs, outputs, gen_indexes
-    except Exception as e:
-        print 'caught exception in gen_from_index: ', e
-        print 'len generators = %d | t = %d' % (len(generators), t)
-
-
 def generate_train_data(generators, num_train, batch_size, current_model):
     current_model, indexes = create_indexes(num_train, len(generators), current_model)
     num_batches = int(np.floor(len(indexes) / batch_size))
     indexes = indexes[0:num_batches * batch_size]  # dump extra data
-    inputs, outputs, _ = _generate_from_index(generators, indexes)
+    inputs, outputs, _ = generate_from_index(generators, indexes)
     return inputs, outputs, indexes, current_model
 
 
+def start_input_streams(input_queue, prefetcher, gen_angles, batch_size):
+    ''' feeds the prefetched train batches [one queue entry per minibatch,
+        info = (indexes, current_model)] and TEST_SET to the graph input '''
+    def train_batches():
+        while True:
+            inputs, _, indexes, current_model = prefetcher.get()
+            for start, end in zip(range(0, len(inputs) + 1, batch_size),
+                                  range(batch_size, len(inputs) + 1, batch_size)):
+                yield [inputs[start:end], gen_angles[indexes[start:end]]], \
+                    (indexes[start:end], current_model)
+
+    # the feeder thread gets its own view of TEST_SET [next_batch reuses
+    # its buffers & cursor] and queues copies of the batches
+    test_set = TEST_SET.filter([])
+    test_angles = np.zeros(batch_size, dtype=np.float32)
+    input_queue.start("train", train_batches().next)
+    input_queue.start("test", lambda: ([test_set.next_batch(batch_size,
+                                                            copy=True)[0],
+                                        test_angles], None))
+
+
 def generate_test_data(generators, num_train, batch_size):
     indexes = list(np.arange(len(generators))) * num_train
     num_batches = int(np.floor(len(indexes) / batch_size))
     indexes = indexes[0:num_batches * batch_size]  # dump extra data
-    return _generate_from_index(generators, indexes)
+    return generate_from_index(generators, indexes)
 
 
 def evaluate_running_hist(vae):
@@ -518,12 +603,17 @@ def evaluate_running_hist(vae):
 
 def rotate_mnist(generators):
     ''' rotates mnist to the angles specified below
-        adds (10x + 1) the number of distributions'''
+        adds (10x + 1) the number of distributions
+        [with graph_augment only the angle is kept, rotation is in-graph]'''
     rotated = []
     for n in xrange(len(generators)):
-        for t in [30, 45, 70, 90, 130, 165, 200, 250, 295, 335]:
+        for t in ROTATION_ANGLES:
             number = MNIST_Number(n, full_mnist, False)
-            number.mnist = MNIST_Number.rotate_all_sets(number.mnist, n, t)
+            if FLAGS.graph_augment:
+                number.angle = t
+            else:
+                number.mnist = MNIST_Number.rotate_all_sets(number.mnist, n, t)
+
             rotated.append(number)
 
     generators = generators + rotated
@@ -533,11 +623,14 @@ def rotate_mnist(generators):
 
 def main():
     if FLAGS.sequential:
+        # with graph_augment the resize / rgb happens on VAE.x instead
+        variant = {} if FLAGS.graph_augment \
+            else {'resize_dims': [32, 32], 'convert_to_rgb': True}
         generators = [MNIST_Number(i, full_mnist, is_one_vs_all=False,
-                                   resize_dims=[32, 32], convert_to_rgb=True)
+                                   **variant)
                       for i in xrange(10)]
     else:
-        generators = [input_data.read_data_sets('MNIST_data', one_hot=True)]
+        generators = [load_mnist(one_hot=True)]
 
     # rotate mnist if specified
     if FLAGS.rotate_mnist:
@@ -576,9 +669,7 @@ def main():
                     x_sample, y_sample = generators[0].test.next_batch(10000)
                 elif FLAGS.sequential:
                     x_sample, y_sample \
-                        = input_data.read_data_sets('MNIST_data',
-                                                    one_hot=True)\
-                                    .test.next_batch(10000)
+                        = load_mnist(one_hot=True).test.next_batch(10000)
 
                 plot_2d_vae(sess, x_sample, y_sample,
                             vae, FLAGS.batch_size)
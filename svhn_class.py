@@ -5,12 +5,11 @@ import scipy
 import sys
 import h5py
 import tarfile
+import zlib
 import PIL.Image as Image
 import numpy as np
 import tensorflow.contrib.keras as K
 
-from copy import deepcopy
-from utils import zip_filter_unzip
 from tensorflow.python.framework import dtypes
 from scipy.io import loadmat
 from sklearn.cross_validation import train_test_split
@@ -18,7 +17,8 @@ from itertools import product
 from six.moves.urllib.request import urlretrieve
 from sklearn.preprocessing import MinMaxScaler
 
-from cifar_class import DataSet
+from data_store import DataSet, filter_splits, load_or_build_store, open_store, \
+    parallel_imap, StoreWriter, store_exists, store_is_stale, write_signature
 
 
 # modified https://github.com/bdiesel, see there for original
@@ -94,6 +94,46 @@ class DigitStruct:
         print("Done extract")
         return structs
 
+    def _read_attr(self, attr):
+        ''' reads a bbox attribute with a single read; multi-digit
+            attributes hold references to the per-digit scalars '''
+        values = attr[()].ravel()
+        if len(values) > 1:
+            return [self.file[ref][()].item() for ref in values]
+        return [values[0].item()]
+
+    def get_digit_structures(self, begin, end):
+        ''' bulk variant of get_digit_structure for [begin, end): only the
+            outer name & bbox reference arrays are fetched in one read each;
+            every image [and every digit of a multi-digit bbox] is still
+            one h5py dereference, the speedup comes from decoding ranges
+            on a process pool [see read_digit_struct] '''
+        name_refs = self.digit_struct_name[begin:end, 0]
+        bbox_refs = self.digit_struct_bbox[begin:end, 0]
+        structs = []
+        for name_ref, bbox_ref in zip(name_refs, bbox_refs):
+            bb = self.file[bbox_ref]
+            structure = dict((key, self._read_attr(bb[key]))
+                             for key in ['label', 'top', 'left', 'height', 'width'])
+            structure['name'] = self.file[name_ref][()].ravel().astype(np.uint8).tostring()
+            structs.append(structure)
+
+        return structs
+
+    def __len__(self):
+        return len(self.digit_struct_name)
+
+
+def _decode_digit_structs(args):
+    ''' decodes a range of the digitStruct in a worker process
+        [h5py handles can not be shared across processes] '''
+    struct_file, begin, end = args
+    dstruct = DigitStruct(struct_file)
+    try:
+        return dstruct.get_digit_structures(begin, end)
+    finally:
+        dstruct.file.close()
+
 
 def read_data_file(file_name):
     file = open(file_name, 'rb')
@@ -102,10 +142,19 @@ def read_data_file(file_name):
     return data
 
 
-def read_digit_struct(data_path):
+def read_digit_struct(data_path, chunk_size=4096, num_workers=None):
     struct_file = os.path.join(data_path, "digitStruct.mat")
     dstruct = DigitStruct(struct_file)
-    structs = dstruct.get_all_imgs_and_digit_structure()
+    data_count = len(dstruct)
+    dstruct.file.close()
+
+    structs = []
+    tasks = [(struct_file, begin, min(begin + chunk_size, data_count))
+             for begin in range(0, data_count, chunk_size)]
+    for chunk in parallel_imap(_decode_digit_structs, tasks, num_workers):
+        structs.extend(chunk)
+
+    print("Done extract")
     return structs
 
 
@@ -152,6 +201,146 @@ def process_data_file(file):
     return img_array, labels_one_hot
 
 
+# MATLAB v5 element types [see the MAT-File Format reference]
+MI_MATRIX = 14
+MI_COMPRESSED = 15
+MAT_DTYPES = {1: '<i1', 2: '<u1', 3: '<i2', 4: '<u2', 5: '<i4',
+              6: '<u4', 7: '<f4', 9: '<f8', 12: '<i8', 13: '<u8'}
+
+
+class _InflateStream(object):
+    ''' file-like reads over a zlib compressed element, inflating
+        at most block_size bytes at a time '''
+    def __init__(self, file, compressed_bytes, block_size=1 << 22):
+        self.file = file
+        self.left = compressed_bytes
+        self.block_size = block_size
+        self.inflate = zlib.decompressobj()
+        self.buf = b''
+
+    def read(self, n):
+        out = [self.buf]
+        have = len(self.buf)
+        while have < n:
+            raw = self.inflate.unconsumed_tail
+            if not raw:
+                raw = self.file.read(min(self.block_size, self.left))
+                self.left -= len(raw)
+                if not raw:
+                    break
+
+            chunk = self.inflate.decompress(raw, max(n - have, self.block_size))
+            out.append(chunk)
+            have += len(chunk)
+
+        data = b''.join(out)
+        self.buf = data[n:]
+        return data[:n]
+
+
+def _read_mat_tag(stream):
+    ''' returns (type, nbytes, data) where data is only set for
+        small [<= 4 byte] elements that are packed into the tag '''
+    tag = stream.read(8)
+    mtype, nbytes = struct.unpack('<II', tag)
+    if mtype >> 16:
+        return mtype & 0xffff, mtype >> 16, tag[4:4 + (mtype >> 16)]
+    return mtype, nbytes, None
+
+
+def _read_mat_element(stream):
+    mtype, nbytes, data = _read_mat_tag(stream)
+    if data is None:
+        data = stream.read(nbytes)
+        stream.read(-nbytes % 8)  # padding
+    return mtype, data
+
+
+def _read_mat_matrix_header(stream):
+    ''' parses a numeric miMATRIX up to its real part:
+        returns (name, dims, dtype, nbytes, small data) '''
+    _read_mat_element(stream)  # array flags
+    dims = np.frombuffer(_read_mat_element(stream)[1], dtype='<i4')
+    name = _read_mat_element(stream)[1].rstrip(b'\x00')
+    mtype, nbytes, data = _read_mat_tag(stream)
+    return name, dims, np.dtype(MAT_DTYPES[mtype]), nbytes, data
+
+
+def stream_mat_to_store(file_name, name, split, path, chunk_size=4096):
+    '''
+    Converts the X [32, 32, 3, N] & y variables of a cropped SVHN .mat
+    file to a uint8 [N, 32, 32, 3] store without ever loading the split:
+    the (compressed) variables are inflated and written chunk_size images
+    at a time, so memory stays bounded regardless of the split size.
+    '''
+    writer = None
+    labels = None
+    with open(file_name, 'rb') as f:
+        header = f.read(128)
+        if header[126:128] != b'IM':
+            raise Exception('only little-endian v5 .mat files can be streamed')
+
+        while True:
+            tag = f.read(8)
+            if len(tag) < 8:
+                break
+
+            mtype, nbytes = struct.unpack('<II', tag)
+            end = f.tell() + nbytes
+            stream = f
+            if mtype == MI_COMPRESSED:
+                stream = _InflateStream(f, nbytes)
+                mtype, _, _ = _read_mat_tag(stream)
+            else:
+                end += -nbytes % 8
+
+            if mtype == MI_MATRIX:
+                var_name, dims, dtype, nbytes, data = _read_mat_matrix_header(stream)
+                if var_name == b'X':
+                    # column-major: every image is a contiguous [C, W, H] block
+                    num_imgs, img_shape = dims[-1], tuple(dims[:-1])
+                    img_bytes = int(np.prod(img_shape)) * dtype.itemsize
+                    writer = StoreWriter(name, split, (num_imgs,) + img_shape, path)
+                    for begin in range(0, num_imgs, chunk_size):
+                        count = min(chunk_size, num_imgs - begin)
+                        chunk = np.frombuffer(stream.read(count * img_bytes), dtype=dtype)
+                        chunk = chunk.reshape((count,) + img_shape[::-1])
+                        writer.write(begin, chunk.transpose(0, 3, 2, 1))
+                elif var_name == b'y':
+                    data = stream.read(nbytes) if data is None else data
+                    labels = np.frombuffer(data, dtype=dtype).astype(np.int32)
+
+            f.seek(end)
+
+    labels[labels == 10] = 0  # Fix for weird labeling in dataset
+    writer.close(labels)
+
+
+def load_svhn_split(dataset, one_hot=False, path=CROPPED_DATA_PATH):
+    '''
+    Out-of-core counterpart of create_svhn for the cropped splits
+    [meant for extra, 1.3Gb]: the .mat file is streamed once into a
+    memory-mapped uint8 store, rebuilt only when the .mat file changes,
+    and returned as a DataSet that scales to [0, 1] per batch.
+    '''
+    data_file_name = get_data_file_name('cropped', dataset)
+    data_file_pointer = os.path.join(path, data_file_name)
+    if not os.path.isfile(data_file_pointer):
+        make_data_dirs('cropped')
+        data_file_pointer = download_data_file(path, data_file_name)
+
+    if not store_exists('svhn', [dataset], path) \
+       or store_is_stale('svhn', [data_file_pointer], path):
+        stream_mat_to_store(data_file_pointer, 'svhn', dataset, path)
+        write_signature('svhn', [data_file_pointer], path)
+
+    images, labels = open_store('svhn', dataset, path)
+    if one_hot:
+        labels = np.eye(NUM_LABELS, dtype=np.float32)[labels]
+
+    return DataSet(images, labels, one_hot, store_key=('svhn', dataset))
+
+
 def get_data_file_name(master_set, dataset):
     if master_set == "cropped":
         if dataset == "train":
@@ -185,8 +374,29 @@ def make_data_dirs(master_set):
         raise Exception('Master data set must be full or cropped')
 
 
-def handle_tar_file(file_pointer):
-    ''' Extract and return the data file '''
+def _crop_resize_chunk(args):
+    ''' crops & resizes a chunk of images in a worker process '''
+    extract_dir, structs = args
+    img_data = np.zeros((len(structs), OUT_HEIGHT, OUT_WIDTH, NUM_CHANNELS),
+                        dtype='float32')
+    labels = np.zeros((len(structs), MAX_LABELS+1), dtype='int8')
+    for i, struct in enumerate(structs):
+        lbls = struct['label']
+        file_name = os.path.join(extract_dir, struct['name'])
+        if(len(lbls) < MAX_LABELS):
+            labels[i] = create_label_array(lbls)
+            img_data[i] = create_img_array(file_name, struct['top'], struct['left'],
+                                           struct['height'], struct['width'],
+                                           OUT_HEIGHT, OUT_WIDTH)
+        else:
+            print("Skipping {}, only images with less than {} numbers are allowed!".format(file_name, MAX_LABELS))
+
+    return img_data, labels
+
+
+def handle_tar_file(file_pointer, chunk_size=1024, num_workers=None):
+    ''' Extract the data file; the crops are generated on a process
+        pool and streamed into a preallocated on-disk array '''
     print ("extract", file_pointer)
     extract_data_file(file_pointer)
     extract_dir = os.path.splitext(os.path.splitext(file_pointer)[0])[0]
@@ -194,25 +404,27 @@ def handle_tar_file(file_pointer):
     structs = read_digit_struct(extract_dir)
     data_count = len(structs)
 
-    img_data = np.zeros((data_count, OUT_HEIGHT, OUT_WIDTH, NUM_CHANNELS),
-                        dtype='float32')
+    img_file = extract_dir + "_imgs.npy"
+    tmp_file = "%s.%d.tmp" % (img_file, os.getpid())
+    img_data = np.lib.format.open_memmap(tmp_file, mode='w+', dtype='float32',
+                                         shape=(data_count, OUT_HEIGHT,
+                                                OUT_WIDTH, NUM_CHANNELS))
     labels = np.zeros((data_count, MAX_LABELS+1), dtype='int8')
 
-    for i in range(data_count):
-        lbls = structs[i]['label']
-        file_name = os.path.join(extract_dir, structs[i]['name'])
-        top = structs[i]['top']
-        left = structs[i]['left']
-        height = structs[i]['height']
-        width = structs[i]['width']
-        if(len(lbls) < MAX_LABELS):
-            labels[i] = create_label_array(lbls)
-            img_data[i] = create_img_array(file_name, top, left, height, width,
-                                           OUT_HEIGHT, OUT_WIDTH)
-        else:
-            print("Skipping {}, only images with less than {} numbers are allowed!").format(file_name, MAX_LABELS)
+    chunks = [(begin, min(begin + chunk_size, data_count))
+              for begin in range(0, data_count, chunk_size)]
+    results = parallel_imap(_crop_resize_chunk,
+                            [(extract_dir, structs[begin:end])
+                             for begin, end in chunks],
+                            num_workers)
+    for (begin, end), (chunk_imgs, chunk_labels) in zip(chunks, results):
+        img_data[begin:end] = chunk_imgs
+        labels[begin:end] = chunk_labels
 
-    return img_data, labels
+    img_data.flush()
+    del img_data
+    os.rename(tmp_file, img_file)
+    return np.load(img_file, mmap_mode='r'), labels
 
 
 def create_svhn(dataset, master_set):
@@ -297,11 +509,8 @@ def write_npy_file(data_array, lbl_array, data_set_name, data_path):
 
 
 def load_svhn_data(data_type, data_set_name):
-    # TODO add error handling here
-    path = DATA_PATH + data_set_name
-    imgs = np.load(os.path.join(path, data_set_name+'_'+data_type+'_imgs.npy'))
-    labels = np.load(os.path.join(path, data_set_name+'_'+data_type+'_labels.npy'))
-    return imgs, labels
+    ''' memory-maps the cached images of a split [see generate_cropped_files] '''
+    return open_store(data_set_name, data_type, DATA_PATH + data_set_name)
 
 
 def create_label_array(el):
@@ -336,12 +545,34 @@ def create_img_array(file_name, top, left, height, width, out_height, out_width)
     return norm_pix
 
 
+def write_npy_rows(data_array, rows, lbl_array, data_set_name, data_path,
+                   chunk_size=4096):
+    ''' write_npy_file for the given rows of a (memory-mapped) array,
+        gathered chunk-wise so the split never has to fit in memory '''
+    img_file = os.path.join(DATA_PATH+data_path, data_path+"_"+data_set_name+'_imgs.npy')
+    out = np.lib.format.open_memmap(img_file, mode='w+', dtype=data_array.dtype,
+                                    shape=(len(rows),) + data_array.shape[1:])
+    for begin in range(0, len(rows), chunk_size):
+        out[begin:begin+chunk_size] = data_array[rows[begin:begin+chunk_size]]
+
+    out.flush()
+    del out
+    print('Saving to %s_svhn_imgs.npy file done.' % data_set_name)
+    np.save(os.path.join(DATA_PATH+data_path, data_path+"_"+data_set_name+'_labels.npy'), lbl_array[rows])
+    print('Saving to %s_svhn_labels.npy file done.' % data_set_name)
+    return np.load(img_file, mmap_mode='r'), lbl_array[rows]
+
+
 def generate_full_files():
-    train_data, train_labels = create_svhn('train', 'full')
-    train_data, valid_data, train_labels, valid_labels = train_validation_spit(train_data, train_labels)
+    all_train_data, all_train_labels = create_svhn('train', 'full')
 
-    write_npy_file(train_data, train_labels, 'train', 'full')
-    write_npy_file(valid_data, valid_labels, 'valid', 'full')
+    # same rows as splitting the arrays themselves [same random_state]
+    train_rows, valid_rows = train_test_split(np.arange(len(all_train_labels)),
+                                              test_size=0.1, random_state=42)
+    train_data, train_labels = write_npy_rows(all_train_data, np.sort(train_rows),
+                                              all_train_labels, 'train', 'full')
+    valid_data, valid_labels = write_npy_rows(all_train_data, np.sort(valid_rows),
+                                              all_train_labels, 'valid', 'full')
 
     test_data, test_labels = create_svhn('test', 'full')
     write_npy_file(test_data, test_labels, 'test', 'full')
@@ -354,20 +585,44 @@ def generate_full_files():
             test_data, test_labels]
 
 
-def generate_cropped_files():
+def _cropped_sources():
+    return [os.path.join(CROPPED_DATA_PATH, get_data_file_name('cropped', dataset))
+            for dataset in ['train', 'test']]
+
+
+def _build_cropped_files():
     train_data, train_labels = create_svhn('train', 'cropped')
     train_data, valid_data, train_labels, valid_labels = train_validation_spit(train_data, train_labels)
+    test_data, test_labels = create_svhn('test', 'cropped')
 
-    write_npy_file(train_data, train_labels, 'train', 'cropped')
-    write_npy_file(valid_data, valid_labels, 'valid', 'cropped')
+    #XXX: de-one-hotify for Dataset class
+    return {'train': (train_data, np.argmax(train_labels, axis=1)),
+            'valid': (valid_data, np.argmax(valid_labels, axis=1)),
+            'test': (test_data, np.argmax(test_labels, axis=1))}
 
-    test_data, test_labels = create_svhn('test', 'cropped')
-    write_npy_file(test_data, test_labels, 'test', 'cropped')
+
+def generate_cropped_files():
+    ''' parses, scales & splits the cropped .mat files only once; the
+        cached arrays are then memory-mapped until the .mat files change '''
+    splits = load_or_build_store('cropped', ['train', 'valid', 'test'],
+                                 _build_cropped_files,
+                                 path=CROPPED_DATA_PATH,
+                                 sources=_cropped_sources(),
+                                 images_dtype=np.float32)
     print("Cropped Files Done!!!")
 
-    return [train_data, train_labels,
-            valid_data, valid_labels,
-            test_data, test_labels]
+    return [splits['train'][0], splits['train'][1],
+            splits['valid'][0], splits['valid'][1],
+            splits['test'][0], splits['test'][1]]
+
+
+def _mix_batches(train_batch_fn, extra_batch_fn, batch_size, extra_fraction):
+    ''' batch_size rows, each drawn from the extra split w.p. extra_fraction '''
+    num_extra = np.random.binomial(batch_size, extra_fraction)
+    train_images, train_labels = train_batch_fn(batch_size - num_extra)
+    extra_images, extra_labels = extra_batch_fn(num_extra)
+    return np.concatenate([train_images, extra_images]), \
+        np.concatenate([train_labels, extra_labels])
 
 
 # An object that filters the classes of svhn
@@ -379,22 +634,18 @@ class SVHN_Class(object):
         self.blacklist.remove(self.number)
         self.classes = self.filter_classes(svhn, self.blacklist)
 
+        # train batches also draw from the extra split if it is loaded
+        # [see SVHN.use_extra], in proportion to the class sizes
+        self.extra = svhn.extra
+        if self.extra is not None:
+            num_train = len(self.classes.train.label_index().get(self.number, []))
+            num_extra = len(self.extra.label_index().get(self.number, []))
+            self.extra_fraction = num_extra / float(num_train + num_extra)
+
     @staticmethod
     def filter_classes(svhn, blacklist):
-        classes = deepcopy(svhn)
-        classes.train._images, classes.train._labels = zip_filter_unzip(classes.train._images,
-                                                                        classes.train._labels,
-                                                                        blacklist)
-        classes.train._images = np.array(classes.train._images)
-        classes.train._labels = np.array(classes.train._labels)
-        classes.train._num_examples = len(classes.train.images)
-        classes.test._images, classes.test._labels = zip_filter_unzip(classes.test._images,
-                                                                      classes.test._labels,
-                                                                      blacklist)
-        classes.test._images = np.array(classes.test._images)
-        classes.test._labels = np.array(classes.test._labels)
-        classes.test._num_examples = len(classes.test.images)
-        return classes
+        ''' index views over the shared splits, nothing is copied '''
+        return filter_splits(svhn, blacklist)
 
     # if one vs. all then 0 = true class, 1 = other
     # otherwise we just use lbl = lbl,  10 = other
@@ -420,52 +671,54 @@ class SVHN_Class(object):
         return np.array(images), np.array(labels)
 
     def get_test_batch_iter(self, batch_size):
-        images = []; labels = []; count = 0
-        while(count < batch_size):
-            max_batch = self.classes.test._num_examples
-            im, lbl = self._get_test_batch_iter(max_batch)
-            tar = self.number
-            if tar in lbl:
-                im, lbl = zip_filter_unzip(im, lbl, self.blacklist)
-                count += len(im)
-                #  im = np.asarray(im); lbl = np.asarray(lbl); count += len(lbl)
-                images.append(im); labels.append(lbl)
-
-        return np.vstack(images)[0:batch_size], np.hstack(labels)[0:batch_size]
+        # only the test examples of our class
+        return self.classes.test.class_sampler([self.number]).next_batch(batch_size)
 
     def get_batch_iter(self, batch_size):
-        images = []; labels = []; count = 0
-        while(count < batch_size):
-            im, lbl = self.get_train_batch_iter(batch_size)
-            tar = self.number
-            if tar in lbl:
-                # im, lbl = zip_filter_unzip(im, lbl, self.blacklist)
-                im = np.asarray(im); lbl = np.asarray(lbl); count += len(lbl)
-                images.append(im); labels.append(lbl)
+        train = self.classes.train.class_sampler([self.number])
+        if self.extra is None:
+            return train.next_batch(batch_size)
 
-        return np.vstack(images)[0:batch_size], np.hstack(labels)[0:batch_size]
+        return _mix_batches(train.next_batch,
+                            self.extra.class_sampler([self.number]).next_batch,
+                            batch_size, self.extra_fraction)
 
 class SVHN(object):
-    def __init__(self, one_hot):
+    def __init__(self, one_hot, extra=False):
         train_data, train_labels,\
             valid_data, valid_labels,\
             test_data, test_labels = generate_cropped_files()
         #generate_full_files()
 
-        #XXX: de-one-hotify for Dataset class
-        train_labels = np.argmax(train_labels, axis=1)
-        valid_labels = np.argmax(valid_labels, axis=1)
-        test_labels = np.argmax(test_labels, axis=1)
-        print 'test max = ', np.max(test_data)
-
         self.train = DataSet(train_data, train_labels, one_hot, normalize=False)
         self.validation = DataSet(valid_data, valid_labels, one_hot, normalize=False)
         self.test = DataSet(test_data, test_labels, one_hot, normalize=False)
 
+        # the extra split [531k images] is streamed into its own store
+        self.extra = None
+        if extra:
+            self.use_extra()
+
         # XXX: for compatibility
         self.number = 99998
 
+    def use_extra(self):
+        ''' loads the extra split [once]; train batches then draw from
+            train + extra [see get_batch_iter and SVHN_Class] '''
+        if self.extra is None:
+            # integer labels, as the cropped train split
+            self.extra = load_svhn_split('extra')
+            self.extra_fraction = self.extra.num_examples \
+                / float(self.train.num_examples + self.extra.num_examples)
+
+        return self
+
     def get_batch_iter(self, batch_size):
+        if self.extra is not None:
+            return _mix_batches(self.train.class_sampler().next_batch,
+                                self.extra.class_sampler().next_batch,
+                                batch_size, self.extra_fraction)
+
         images, labels = self.train.next_batch(batch_size)
         return np.array(images), np.array(labels)
 
@@ -5,6 +5,7 @@ import math
 import random
 import hashlib
 import tarfile
+import threading
 import tensorflow as tf
 import numpy as np
 import matplotlib as mpl
@@ -12,6 +13,7 @@ mpl.use('Agg')
 import matplotlib.pyplot as plt
 
 from copy import deepcopy
+from Queue import Queue
 from tensorflow.python.framework import ops
 from sklearn.preprocessing import MinMaxScaler
 
@@ -47,6 +49,142 @@ class BatchBuffer(object):
         return retval
 
 
+class GraphAugment(object):
+    '''
+    Graph-side [rotate, resize, gray -> rgb] of canonical batches, so only
+    the un-augmented stores stay resident. Rotation angles [degrees, ccw]
+    are fed per row and default to 0 [eg: for the test sets]; a dequeued
+    angles tensor can be given instead [see QueueInput].
+    '''
+    def __init__(self, batch_size, img_dims=[28, 28], resize_dims=None,
+                 channels=1, rotate=False, is_flat=True, angles=None):
+        self.img_dims = list(img_dims)
+        self.out_dims = list(resize_dims) if resize_dims is not None \
+            else list(img_dims)
+        self.channels = channels
+        self.rotate = rotate
+        self.is_flat = is_flat
+        self.angles = angles if angles is not None \
+            else tf.placeholder_with_default(tf.zeros([batch_size]),
+                                             shape=[batch_size],
+                                             name="augment_angles")
+
+    @property
+    def img_shape(self):
+        return self.out_dims + [self.channels]
+
+    @property
+    def output_size(self):
+        return int(np.prod(self.img_shape))
+
+    def __call__(self, x):
+        with tf.name_scope("augment"):
+            batch_size = x.get_shape().as_list()[0]
+            imgs = tf.reshape(x, [batch_size] + self.img_dims + [1])
+            if self.rotate:
+                imgs = tf.contrib.image.rotate(imgs,
+                                               self.angles * (math.pi / 180.0),
+                                               interpolation='BILINEAR')
+
+            if self.out_dims != self.img_dims:
+                imgs = tf.image.resize_bilinear(imgs, self.out_dims,
+                                                align_corners=True)
+
+            # broadcast the single channel [no-op for gray models]
+            if self.channels > 1:
+                imgs = tf.tile(imgs, [1, 1, 1, self.channels])
+
+            if self.is_flat:
+                return tf.reshape(imgs, [batch_size, self.output_size])
+
+            return imgs
+
+    def feed(self, angles):
+        return {self.angles: angles} if self.rotate else {}
+
+
+class QueueInput(object):
+    '''
+    Graph-side model input: every stream [eg: train / test] is a FIFOQueue
+    filled by its own feeder thread and the components [eg: x, angles] are
+    dequeued from whichever stream is active, so a training step needs no
+    array feeds. batch_fn() -> (arrays, info) returns one batch per call
+    [None ends the stream]; a non-None info is handed back in enqueue order
+    by next_info(stream), ie: it describes the next batch that is dequeued.
+    '''
+    def __init__(self, sess, shapes, dtypes=None, streams=["train", "test"],
+                 capacity=8):
+        self.sess = sess
+        self.streams = list(streams)
+        dtypes = dtypes if dtypes is not None else [tf.float32] * len(shapes)
+        self.placeholders, self.enqueue_ops, self.use_ops = {}, {}, {}
+        self.infos, self.feeders = {}, []
+        self.running = True
+
+        with tf.name_scope("input_queue"):
+            # local [not part of any model / saver], initialized below
+            self.active = tf.Variable(0, trainable=False, name="active_stream",
+                                      collections=[tf.GraphKeys.LOCAL_VARIABLES])
+            queues = []
+            for index, stream in enumerate(self.streams):
+                queue = tf.FIFOQueue(capacity, dtypes, shapes=shapes,
+                                     name="%s_queue" % stream)
+                self.placeholders[stream] = [tf.placeholder(dtype, shape)
+                                             for dtype, shape
+                                             in zip(dtypes, shapes)]
+                self.enqueue_ops[stream] = queue.enqueue(self.placeholders[stream])
+                self.use_ops[stream] = self.active.assign(index)
+                queues.append(queue)
+
+            components = tf.QueueBase.from_list(self.active, queues).dequeue()
+            self.components = components if isinstance(components, list) \
+                else [components]
+            self.close_op = tf.group(*[q.close(cancel_pending_enqueues=True)
+                                       for q in queues])
+
+        self.sess.run(self.active.initializer)
+
+    def use(self, stream):
+        self.sess.run(self.use_ops[stream])
+
+    def start(self, stream, batch_fn):
+        self.infos[stream] = Queue()
+        feeder = threading.Thread(target=self._feed, args=(stream, batch_fn))
+        feeder.daemon = True
+        feeder.start()
+        self.feeders.append(feeder)
+
+    def _feed(self, stream, batch_fn):
+        try:
+            while self.running:
+                batch = batch_fn()
+                if batch is None:
+                    break
+
+                arrays, info = batch
+                self.sess.run(self.enqueue_ops[stream],
+                              feed_dict=dict(zip(self.placeholders[stream],
+                                                 arrays)))
+                if info is not None:
+                    self.infos[stream].put(info)
+
+        except tf.errors.CancelledError:
+            pass  # queue closed
+        except Exception as e:
+            print 'caught exception in %s input stream: ' % stream, e
+
+        self.infos[stream].put(None)
+
+    def next_info(self, stream="train"):
+        return self.infos[stream].get()
+
+    def close(self):
+        self.running = False
+        self.sess.run(self.close_op)
+        for feeder in self.feeders:
+            feeder.join(1)
+
+
 def random_str(length):
     return ''.join(random.SystemRandom().choice(string.ascii_uppercase + string.digits) for _ in range(length))
 
@@ -1,5 +1,4 @@
 import os
-import sys
 import datetime
 import numpy as np
 import tensorflow as tf
@@ -13,7 +12,6 @@ from utils import *
 
 sg = tf.contrib.bayesflow.stochastic_graph
 st = tf.contrib.bayesflow.stochastic_tensor
-sys.setrecursionlimit(200)
 
 # Global variables
 GLOBAL_ITER = 0  # keeps track of the iteration ACROSS models
@@ -293,7 +291,7 @@ class VanillaVAE(object):
                 # generate variability
                 self.z_tm1, self.z_discrete_tm1, self.xhat_tm1 \
                     = self.generate_at_least(self.vae_tm1,
-                                             self.batch_size)
+                                             self.num_old_data)
 
                 print 'z_tm1 = ', self.z_tm1.get_shape().as_list(), \
                     '| xhat_tm1 = ', self.xhat_tm1.get_shape().as_list()